@@ -7,7 +7,6 @@ import re
 import sys
 import logging
 import subprocess
-import pkg_resources
 import threading as th
 import tempfile
 import csv
@@ -15,12 +14,14 @@ import shutil
 import sqlite3
 import json
 import gzip
-import pkg_resources
+import struct
 import glob
-import distutils
-import distutils.util
+import heapq
+import pickle
+import shlex
+import collections
 
-from .utils import run_tools, CommandException, try_get_exclusive
+from .utils import run_tools, MD5Writer, CommandException, begin_immediate, package_resource, strtobool, ResourceScheduler, parse_region, parse_memory, bcf_sort_key, bam_mapped_reads
 from .parser import gembsConfigParse
 from .database import *
 
@@ -33,8 +34,33 @@ class execs_dict(dict):
     the path to the bundled executable is returned.
     If nothing is found, the plain executable name is returned and we
     assume it can be found in PATH
+
+    Resolved paths are cached for the lifetime of the process.  If a
+    cache file has been set with set_cache() then the resolved paths and the
+    results of version() and supports() are also kept on disk.  The paths are
+    keyed by the search path (and the modification times of its directories),
+    the probe results by the path, size and modification time of the binary.
     """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._lock = th.Lock()
+        self._paths = {}
+        self._probes = {}
+        self._cache_file = None
+        self._cache = None
+        
     def __getitem__(self, item):
+        with self._lock:
+            if not item in self._paths:
+                path = self._cached_path(item)
+                if path == None:
+                    path = self._resolve(item)
+                    self._store('paths', item, path)
+                self._paths[item] = path
+            return self._paths[item]
+
+    def _resolve(self, item):
         # check if there is an environment variable set
         # to specify the path to the GEM executables
         
@@ -45,13 +71,13 @@ class execs_dict(dict):
                 logging.debug("Using binary from GEM_BS_PATH : %s" % file)
                 return file
 
-        if pkg_resources.resource_exists("gemBS", os.path.join('gemBSbinaries', item)):
-            f = pkg_resources.resource_filename("gemBS", os.path.join('gemBSbinaries', item))
+        f = package_resource(os.path.join('gemBSbinaries', item))
+        if f != None:
             logging.debug("Using bundled binary : %s" % f)
             return f
             
-        if pkg_resources.resource_exists("gemBS", os.path.join('bin', item)):
-            f = pkg_resources.resource_filename("gemBS", os.path.join('bin',item))
+        f = package_resource(os.path.join('bin', item))
+        if f != None:
             logging.debug("Using bundled binary : %s" % f)
             return f
         
@@ -82,6 +108,105 @@ class execs_dict(dict):
         
         return None
 
+    def set_cache(self, cache_file):
+        """Keep the resolved paths and probe results in cache_file"""
+        with self._lock:
+            self._cache_file = cache_file
+            self._cache = None
+            
+    def _load_cache(self):
+        if self._cache == None:
+            self._cache = {}
+            if self._cache_file != None:
+                try:
+                    with open(self._cache_file) as f:
+                        self._cache = json.load(f)
+                except (OSError, ValueError):
+                    pass
+            key = self._search_key()
+            if self._cache.get('key') != key:
+                self._cache = {'key': key, 'paths': {}, 'probes': {}}
+        return self._cache
+
+    def _store(self, section, key, value):
+        if self._cache_file == None:
+            return
+        cache = self._load_cache()
+        cache[section][key] = value
+        try:
+            dname = os.path.dirname(self._cache_file)
+            fd, tmp = tempfile.mkstemp(dir = dname if dname else '.')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp, self._cache_file)
+        except OSError:
+            pass
+        
+    def _search_key(self):
+        # Everything that can change the result of _resolve()
+        dirs = [os.getenv("GEM_BS_PATH", ""), package_resource('gemBSbinaries'), package_resource('bin')]
+        if len(sys.argv) > 0:
+            dirs.append(os.path.split(os.path.abspath(sys.argv[0]))[0])
+        dirs.extend(os.environ.get("PATH", "").split(os.pathsep))
+        key = []
+        for d in dirs:
+            try:
+                key.append([d, os.stat(d).st_mtime])
+            except (OSError, TypeError):
+                key.append([d, None])
+        return key
+
+    def _cached_path(self, item):
+        if self._cache_file == None:
+            return None
+        path = self._load_cache()['paths'].get(item)
+        if path != None and os.path.isabs(path) and not os.access(path, os.X_OK):
+            path = None
+        return path
+
+    def _probe(self, item, args, parse):
+        path = self[item]
+        try:
+            st = os.stat(path)
+            key = '{}:{}:{}:{}'.format(path, st.st_size, st.st_mtime, ' '.join(args))
+        except (OSError, TypeError):
+            key = '{}:{}'.format(path, ' '.join(args))
+        with self._lock:
+            if not key in self._probes:
+                cache = self._load_cache() if self._cache_file != None else {'probes': {}}
+                if key in cache['probes']:
+                    self._probes[key] = cache['probes'][key]
+            out = self._probes.get(key)
+        if out == None:
+            # The tool is run without holding the lock, so a slow tool does not hold up
+            # the other threads.  Two threads can probe the same tool, which is harmless
+            try:
+                p = subprocess.run([path] + args, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE,
+                                   stderr = subprocess.STDOUT, timeout = 30)
+                out = p.stdout.decode('utf-8', 'replace')
+                with self._lock:
+                    self._store('probes', key, out)
+            except (OSError, subprocess.SubprocessError):
+                out = ''
+            with self._lock:
+                self._probes[key] = out
+        return parse(out)
+
+    def version(self, item):
+        """Version reported by 'item --version', or None if it can not be found"""
+        def parse(out):
+            m = re.search(r'\b(\d+(\.\d+)+)', out)
+            return m.group(1) if m else None
+        return self._probe(item, ['--version'], parse)
+        
+    def supports(self, item, *args):
+        """Check whether the help text of item (followed by any subcommands
+        in args) lists the option given as the last argument, i.e.,
+        executables.supports('samtools', 'sort', '--write-index')
+        """
+        opt = re.compile(r'(?<![\w-])' + re.escape(args[-1]) + r'(?![\w-])')
+        return self._probe(item, list(args[:-1]) + ['--help'], lambda out: opt.search(out) != None)
+
 ## paths to the executables
 executables = execs_dict({
     "readNameClean": "readNameClean",
@@ -100,6 +225,23 @@ executables = execs_dict({
 
 class Fli:
     
+    __slots__ = ('fli', 'alt_fli', 'sample_name', 'sample_barcode', 'description', 'library', 'type',
+                 'file', 'centre', 'platform', 'bisulfite')
+
+    # Map from the keys of a sampleData entry in the JSON file to the Fli member (and an optional conversion)
+    json_keys = {
+        'sample_barcode': ('sample_barcode', None),
+        'library_barcode': ('library', None),
+        'alt_fli': ('alt_fli', None),
+        'description': ('description', None),
+        'sample_name': ('sample_name', None),
+        'type': ('type', None),
+        'file': ('file', None),
+        'centre': ('centre', None),
+        'platform': ('platform', None),
+        'bisulfite': ('bisulfite', lambda x: x if isinstance(x, bool) else json.loads(str(x).lower()))
+    }
+    
     def __init__(self):
         #fli Members
         self.fli = None
@@ -120,20 +262,33 @@ class Fli:
 
 class JSONdata:
     #Class to manage the flowcell lane index information of the project
+    #
+    # Parsing a large gemBS.json (and building a Fli for every dataset) is repeated by every
+    # gemBS invocation, so the processed metadata is kept in a pickled cache next to the JSON
+    # file, keyed by its size and modification time.  The Fli objects and the raw JSON
+    # (only needed when rewriting the file) are built on first use.
+    cache_version = 2
+    
     def __init__(self, json_file = None, jdict = None):
         self.json_file = json_file
-        self.sampleData = {}
         self.config = {}
         self.contigs = {}
         self.pools = {}
+        self._jsconfig = None
+        self._rawData = {}
+        self._sampleData = None
+        self.sample_datasets = {}
+        self.sample_barcodes = {}
         if json_file != None:
-            with open(self.json_file, 'r') as fileJson:
-                self.JSONprocess(json.load(fileJson))
+            if not self.load_cache():
+                with open(self.json_file, 'r') as fileJson:
+                    self.JSONprocess(json.load(fileJson))
+                self.save_cache()
         elif jdict != None:
             self.JSONprocess(jdict)
 
     def JSONprocess(self, jsconfig):
-        self.jsconfig = jsconfig
+        self._jsconfig = jsconfig
         try:
             conf = jsconfig['config']
             defaults = conf['DEFAULT']
@@ -153,35 +308,113 @@ class JSONdata:
             self.contigs[p] = []
             for ctg in v:
                 self.contigs[p].append(ctg)
-                self.pools[ctg]=p
+                self.pools[parse_region(ctg)[0]]=p
                 
-        data=jsconfig['sampleData']
-        for fli in data:
-            fliCommands = Fli()            
-            fliCommands.fli = fli
-            for key, value in data[fli].items():
-                if key == "sample_barcode":
-                    fliCommands.sample_barcode = value    
-                elif key == "library_barcode":
-                    fliCommands.library = value    
-                elif key == "alt_fli":
-                    fliCommands.alt_fli = value
-                elif key == "description":
-                    fliCommands.description = value    
-                elif key == "sample_name":
-                    fliCommands.sample_name = value    
-                elif key == "type":
-                    fliCommands.type = value
-                elif key == "file":
-                    fliCommands.file = value
-                elif key == "centre":
-                    fliCommands.centre = value
-                elif key == "platform":
-                    fliCommands.platform = value
-                elif key == "bisulfite":
-                    fliCommands.bisulfite = json.loads(str(value).lower())
-
-                self.sampleData[fli] = fliCommands
+        self._rawData = jsconfig['sampleData']
+        self._sampleData = None
+        # Indexes from sample barcode to datasets and from sample name to barcode
+        self.sample_datasets = {}
+        self.sample_barcodes = {}
+        for fli, data in self._rawData.items():
+            bc = data.get('sample_barcode')
+            if bc in self.sample_datasets:
+                self.sample_datasets[bc].append(fli)
+            else:
+                self.sample_datasets[bc] = [fli]
+            name = data.get('sample_name', '')
+            if not name in self.sample_barcodes:
+                self.sample_barcodes[name] = bc
+
+    @property
+    def jsconfig(self):
+        if self._jsconfig == None and self.json_file != None:
+            with open(self.json_file, 'r') as fileJson:
+                self._jsconfig = json.load(fileJson)
+        return self._jsconfig
+
+    @property
+    def sampleData(self):
+        if self._sampleData == None:
+            self._sampleData = {}
+            keys = Fli.json_keys
+            for fli, data in self._rawData.items():
+                fliCommands = Fli()            
+                fliCommands.fli = fli
+                for key, value in data.items():
+                    k = keys.get(key)
+                    if k != None:
+                        setattr(fliCommands, k[0], value if k[1] == None else k[1](value))
+                self._sampleData[fli] = fliCommands
+        return self._sampleData
+
+    def get_barcode(self, sample_name):
+        #Get sample barcode from sample name (or None if not found)
+        return self.sample_barcodes.get(sample_name)
+    
+    def get_datasets(self, barcode):
+        #Get list of datasets for a sample barcode
+        return self.sample_datasets.get(barcode, [])
+
+    def cache_file(self, json_file = None):
+        json_file = json_file if json_file != None else self.json_file
+        dname, fname = os.path.split(json_file)
+        return os.path.join(dname, '.' + fname + '.cache')
+
+    def cache_key(self, json_file = None):
+        st = os.stat(json_file if json_file != None else self.json_file)
+        return (JSONdata.cache_version, st.st_size, st.st_mtime_ns)
+    
+    def load_cache(self):
+        try:
+            with open(self.cache_file(), 'rb') as f:
+                cache = pickle.load(f)
+            if cache['key'] != self.cache_key():
+                return False
+        except Exception:
+            return False
+        self.config = cache['config']
+        self.contigs = cache['contigs']
+        self.pools = cache['pools']
+        self._rawData = cache['sampleData']
+        self._sampleData = None
+        self.sample_datasets = cache['sample_datasets']
+        self.sample_barcodes = cache['sample_barcodes']
+        return True
+
+    def save_cache(self):
+        # Store the metadata as read from the file (self.config may since have been updated from the command line)
+        js = JSONdata(jdict = self.jsconfig)
+        cache_file = self.cache_file()
+        try:
+            cache = {'key': self.cache_key(), 'config': js.config, 'contigs': js.contigs, 'pools': js.pools, 'sampleData': js._rawData,
+                     'sample_datasets': js.sample_datasets, 'sample_barcodes': js.sample_barcodes}
+            fd, tmp = tempfile.mkstemp(dir = os.path.dirname(cache_file) or '.')
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass
+
+    def write(self, json_file = None):
+        # Rewrite the JSON file with the current contig pools and refresh the cache
+        jdict = self.jsconfig
+        if json_file != None:
+            self.json_file = json_file
+        jdict['contigs'] = self.contigs
+        with open(self.json_file, 'w') as of:
+            json.dump(jdict, of, indent=2)
+        self.save_cache()
+
+    def copy(self):
+        # Copy with its own configuration and contig pools (which the commands can change);
+        # the sample data is shared
+        js = JSONdata()
+        js.__dict__.update(self.__dict__)
+        js.config = {sect: dict(v) for sect, v in self.config.items()}
+        js.contigs = {pool: list(v) for pool, v in self.contigs.items()}
+        js.pools = dict(self.pools)
+        return js
 
     def check(self, section, key, arg=None, default=None, boolean=False, dir_type=False, list_type=False, int_type = False):
         if not section in self.config:
@@ -208,7 +441,7 @@ class JSONdata:
         self.config[section][key] = ret
         return ret
 
-def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,no_db=False,dbfile=None,output=None):
+def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,no_db=False,dbfile=None,output=None,append=False):
 
     generalDictionary = {}
     cpath = None
@@ -375,7 +608,7 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
                             elif head == "file2":
                                 file2 = field
                             elif head == "bisulfite":
-                                sampleDirectory[head] = bool(distutils.util.strtobool(field.lower()))
+                                sampleDirectory[head] = strtobool(field)
                                 if not sampleDirectory[head]:
                                     nonbs_flag = True;
                             elif head == "type":
@@ -406,8 +639,8 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
                             sampleDirectory['type'] = ft
                             filename = filename.strip()
                         
-                    if fli in generalDictionary:
-                        prev = generalDictionary[fli]
+                    if fli in generalDictionary['sampleData']:
+                        prev = generalDictionary['sampleData'][fli]
                         for key, val in sampleDirectory.items():
                             if key in prev:
                                 if(prev[key] != val):
@@ -415,12 +648,12 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
                             else:
                                 prev[key] = val
                         if filename != None:
-                            prev['file'].update({end: filename});
+                            prev.setdefault('file', {}).update({end: filename});
                         else:
                             if file1 != None:
-                                prev['file'].update({'1': file1});
+                                prev.setdefault('file', {}).update({'1': file1});
                             if file2 != None:
-                                prev['file'].update({'2': file2});
+                                prev.setdefault('file', {}).update({'2': file2});
                     else:
                         if filename != None:
                             sampleDirectory['file'] = {end: filename};
@@ -432,7 +665,7 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
                                 file_dict.update({'2': file2});
                             if len(file_dict) > 0:
                                 sampleDirectory['file'] = file_dict
-                                if len(file_dict) == 2 and not type in sampleDirectory:
+                                if len(file_dict) == 2 and not 'type' in sampleDirectory:
                                     sampleDirectory['type'] = "PAIRED"
                         generalDictionary['sampleData'][fli] = sampleDirectory
             else:
@@ -467,10 +700,32 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
         if inputs_path != None:
             shutil.copy(lims_cnag_json, inputs_path)
 
+    samples = None
     if os.path.exists(jsonOutput):
         js = JSONdata(jsonOutput)
         generalDictionary['contigs']=js.contigs
-        os.remove(jsonOutput)
+        if append:
+            # Add the datasets that are not already in the JSON file.  Only the
+            # db entries for the samples with new datasets are (re)built
+            sdata = js.jsconfig['sampleData']
+            samples = set()
+            for fli, v in generalDictionary['sampleData'].items():
+                if fli in sdata:
+                    if sdata[fli] != v:
+                        logging.warning("Dataset {} already present - new description ignored".format(fli))
+                    continue
+                bc = v.get('sample_barcode')
+                if bc in js.sample_datasets:
+                    logging.warning("New dataset {} for existing sample {}: if the sample BAM has already been made it should be removed".format(fli, bc))
+                sdata[fli] = v
+                samples.add(bc)
+            generalDictionary['sampleData'] = sdata
+            if js.config.get('DEFAULT', {}).get('nonbs_flag', False):
+                nonbs_flag = True
+        else:
+            os.remove(jsonOutput)
+    elif append:
+        raise CommandException("Can not append to JSON file '{}' as it does not exist".format(jsonOutput))
     else:
         generalDictionary['contigs']={}
         
@@ -482,7 +737,7 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
     # Create tables (if not already existing)
     db.create_tables()
     # Check and/or populate tables
-    db.check()
+    db.check(samples = None if database.mem_db() else samples)
     c = db.cursor()
     ix_files = {}
     for fname, ftype, status in c.execute("SELECT * FROM indexing"):
@@ -499,9 +754,7 @@ def prepareConfiguration(text_metadata=None,lims_cnag_json=None,configFile=None,
     if miss_flag:
         printer("\n: To generate missing files run gemBS index")
         
-    generalDictionary['contigs']=js.contigs
-    with open(jsonOutput, 'w') as of:
-        json.dump(generalDictionary, of, indent=2)
+    js.write(jsonOutput)
 
     """Check if file (assumed to exist) is BGZIPPED by checking for magic numbers in the 
     first 16 bytes of the file (according to BGZIP specifications)
@@ -707,11 +960,163 @@ def makeChromSizes(index_name=None,output=None, omit=[]):
     else:
         raise ValueError("Info file {} (normally generated by gem-indexer) does not exist".format(info_file))        
 
+def decompress_command(fname):
+    """Command to decompress fname to stdout, or None if it is not compressed"""
+    if fname.endswith('.gz') or fname.endswith('.z'):
+        return ['gzip', '-dc', fname]
+    if fname.endswith('.xz'):
+        return ['xz', '-dc', fname]
+    if fname.endswith('.bz2'):
+        return ['bzip2', '-dc', fname]
+    return None
+
+# Reads are assigned to the chunks of a dataset in blocks of this many reads (or read pairs)
+chunk_block_size = 65536
+
+# awk programs to select one chunk of the reads.  The input format is taken from the
+# first line, as is done by the mapper: FASTA records run from one '>' line to the next
+# (so the sequence can be on several lines), and FASTQ records are 4 lines.  Records are
+# counted in blocks of b reads (or pairs) and block i is in chunk (i % n) + 1
+chunk_select = r"""
+NR == 1 { fa = (substr($0, 1, 1) == ">") }
+{
+    if (fa) { if (substr($0, 1, 1) == ">") r++ }
+    else if (NR % 4 == 1) r++
+    if (int((r - 1) / (p * b)) % n == k) print
+}
+"""
+
+# Read the two files of a pair in step and write the selected pairs interleaved
+chunk_pairs = r"""
+function rec(c, j,    r, l, i) {
+    if (!(j in la)) return ""
+    r = la[j]
+    delete la[j]
+    if (fa) {
+        while ((c | getline l) > 0) {
+            if (substr(l, 1, 1) == ">") { la[j] = l; return r }
+            r = r "\n" l
+        }
+    } else {
+        for (i = 1; i < 4; i++) {
+            if ((c | getline l) <= 0) exit 1
+            r = r "\n" l
+        }
+        if ((c | getline l) > 0) la[j] = l
+    }
+    return r
+}
+BEGIN {
+    if ((c1 | getline l) > 0) la[1] = l
+    if ((c2 | getline l) > 0) la[2] = l
+    fa = (substr(la[1], 1, 1) == ">")
+    while ((r1 = rec(c1, 1)) != "") {
+        if ((r2 = rec(c2, 2)) == "") exit 1
+        if (int(nr / b) % n == k) print r1 "\n" r2
+        nr++
+    }
+    if (2 in la) exit 1
+}
+"""
+
+def chunk_input(inputFiles=None,ftype=None,paired=False,chunk=None,threads="1"):
+    """ Returns the list of commands that write one chunk of a dataset to stdout
+    as FASTQ or FASTA (interleaved if paired).  The reads are split into blocks of
+    chunk_block_size reads (or pairs), and the blocks are assigned to the chunks in turn.
+    
+    inputFiles -- List of input files
+    ftype -- input file type
+    paired -- Paired End flag
+    chunk -- tuple with the chunk number (1 based) and the number of chunks
+    threads -- Number of threads for the BAM/SAM conversion
+    """
+    k, n = chunk
+    select = ['-v', 'n={}'.format(n), '-v', 'k={}'.format(k - 1), '-v', 'b={}'.format(chunk_block_size)]
+    if len(inputFiles) == 2:
+        cmds = []
+        for f in inputFiles:
+            com = decompress_command(f)
+            cmds.append(' '.join(shlex.quote(x) for x in com) if com else 'cat ' + shlex.quote(f))
+        return [['awk'] + select + ['-v', 'c1=' + cmds[0], '-v', 'c2=' + cmds[1], chunk_pairs]]
+    # Interleaved pairs are two records
+    select.extend(['-v', 'p={}'.format(2 if paired else 1), chunk_select])
+    f = inputFiles[0]
+    if ftype in ['SAM', 'BAM']:
+        return [[executables['samtools'], "bam2fq", "--threads", str(threads), f], ['awk'] + select]
+    com = decompress_command(f)
+    if com:
+        return [com, ['awk'] + select]
+    return [['awk'] + select + [f]]
+
+# Route SAM records to one output pipe per pool shard, by reference name.  The header
+# goes to every shard, and reads on contigs not in the shard map (including unmapped
+# reads) go to the 'other' shard.
+shard_split = r"""
+BEGIN {
+    FS = "\t"
+    while ((getline line < map) > 0) {
+        split(line, a, "\t")
+        out[a[1]] = a[2]
+        files[a[2]] = 1
+    }
+    close(map)
+    files[other] = 1
+    for (f in files) cmd[f] = sort " -T '" tmp (n++) "' -o '" f "' -"
+}
+/^@/ { for (f in files) print | cmd[f]; next }
+{
+    if ($3 in out) print | cmd[out[$3]]
+    else print | cmd[other]
+}
+END {
+    for (f in files) if (close(cmd[f]) != 0) err = 1
+    exit err
+}
+"""
+
+def pool_shards(outfile, contigs):
+    """Shard layout for a mapping task writing one BAM per contig pool
+
+    outfile -- the shards file for the task (<dataset>.shards)
+    contigs -- contig pools (pool name -> list of contigs or contig regions)
+
+    Returns {'contigs': {contig: shard BAM}, 'other': shard BAM for everything else}.
+    Whole contig pools share a shard; a contig split between several pools gets its
+    own shard, and the pools select their region from it when calling.
+    """
+    base = outfile[:-len('.shards')] if outfile.endswith('.shards') else outfile
+    shard_of = {}
+    for pool, regions in contigs.items():
+        pr = [parse_region(r) for r in regions]
+        whole = all(x[1] == None for x in pr)
+        for (ctg, start, end) in pr:
+            shard_of[ctg] = "{}_{}.bam".format(base, pool if whole else ctg)
+    return {'contigs': shard_of, 'other': "{}_@other.bam".format(base)}
+
+def read_shards(fname):
+    """Read the shard layout written by a mapping task (see pool_shards())"""
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+def shard_files(shards):
+    """All BAM files for a shard layout"""
+    return sorted(set(shards['contigs'].values()) | set([shards['other']]))
+
+def expand_bams(files):
+    """Replace shards files in a list of mapping outputs by their BAM files"""
+    bams = []
+    for f in files:
+        if f.endswith('.shards'):
+            bams.extend(shard_files(read_shards(f)))
+        else:
+            bams.append(f)
+    return bams
+
 def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetype=None,
              read_non_stranded=False,reverse_conv=False,outfile=None,
              paired=False,tmpDir="/tmp",map_threads=None,sort_threads=None,
              sort_memory=None,under_conversion=None, over_conversion=None,
-            benchmark_mode=False, contig_md5=None, greference=None):
+            benchmark_mode=False, contig_md5=None, greference=None, chunk=None, shards=None, write_index=False):
     """ Start the GEM Bisulfite mapping on the given input.
     
     name -- Name basic (FLI) for the input and output fastq files
@@ -732,6 +1137,10 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     over_conversion -- Over conversion sequence
     benchmark_mode -- Remove times etc. from output files to simplify file comparisons
     contig_md5 -- File with md5 sums for all contigs
+    chunk -- Only map one chunk of the input (see chunk_input())
+    shards -- Write one BAM per contig pool (see pool_shards()) instead of outfile,
+              which then gets the shard layout
+    write_index -- Index the output BAM (always done for SINGLE_BAM output)
     """        
     ## prepare the input
     input_pipe = []  
@@ -742,13 +1151,15 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     if not os.path.exists(outputDir):
         os.makedirs(outputDir)
 
-    if len(inputFiles) == 2:
+    if chunk != None:
+        input_pipe = chunk_input(inputFiles=inputFiles,ftype=ftype,paired=paired,chunk=chunk,threads=map_threads)
+    elif len(inputFiles) == 2:
         mapping.extend(["--i1",inputFiles[0],"--i2",inputFiles[1]])
     elif len(inputFiles) == 1:
         if ftype in ['SAM', 'BAM']:
-            input_pipe.extend([executables['samtools'],"bam2fq", "--threads", str(map_threads), inputFiles[0]])
+            input_pipe.append([executables['samtools'],"bam2fq", "--threads", str(map_threads), inputFiles[0]])
         elif ftype in ['COMMAND', 'SINGLE_COMMAND', 'PAIRED_COMMAND']:
-            input_pipe.extend(['/bin/sh','-c',inputFiles[0]])            
+            input_pipe.append(['/bin/sh','-c',inputFiles[0]])            
         else:
             mapping.extend(["-i",inputFiles[0]])
         
@@ -792,10 +1203,22 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
     #READ FILTERING
     readNameClean = [executables['readNameClean'], contig_md5]
          
+    if shards != None:
+        return mapping_shards(name, tools=input_pipe + [mapping, readNameClean], outfile=outfile, shards=shards,
+                              tmpDir=tmpDir, sort_threads=sort_threads, sort_memory=sort_memory,
+                              benchmark_mode=benchmark_mode, logfile=logfile)
+    
     #BAM SORT
-    bamSort = [executables['samtools'],"sort","-T",os.path.join(tmpDir,name),"-m",sort_memory,"-o",outfile]
-    if filetype == 'SINGLE_BAM':
-        bamSort.append("--write-index")
+    # The md5 sum of a sample BAM is computed as it is written
+    md5 = MD5Writer(outfile, outfile + '.md5') if filetype == 'SINGLE_BAM' else None
+    bamSort = [executables['samtools'],"sort","-T",os.path.join(tmpDir,name),"-m",sort_memory,"-o",md5.path if md5 else outfile]
+    # Older samtools can not write the index while sorting, so we index afterwards
+    index_after = False
+    if filetype == 'SINGLE_BAM' or write_index:
+        if executables.supports('samtools', 'sort', '--write-index'):
+            bamSort.append("--write-index")
+        else:
+            index_after = True
     if benchmark_mode:
         bamSort.append("--no-PG")
     if outfile.endswith('.cram'):
@@ -807,22 +1230,65 @@ def mapping(name=None,index=None,fliInfo=None,inputFiles=None,ftype=None,filetyp
         
     bamSort.append('-');
     
-    tools = [mapping,readNameClean,bamSort]
-    
-    if input_pipe: tools.insert(0, input_pipe)
+    tools = input_pipe + [mapping,readNameClean,bamSort]
     process = run_tools(tools, name="bisulfite-mapping", logfile=logfile)
-    if process.wait() != 0:
+    ok = process.wait() == 0
+    if (md5 and not md5.close(ok)) or not ok:
         raise ValueError("Error while executing the Bisulfite bisulphite-mapping")
+    if index_after:
+        process = run_tools([[executables['samtools'],"index","-c",outfile]], name="BAM index", logfile=os.path.join(outputDir,"bam_index_{}.err".format(name)))
+        if process.wait() != 0:
+            raise ValueError("Error while indexing the BAM file")
 
     return os.path.abspath("%s" % outfile)
 
-def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benchmark_mode=False, greference=None):
+def mapping_shards(name, tools, outfile, shards, tmpDir, sort_threads, sort_memory, benchmark_mode, logfile):
+    """Sort the output of a mapping pipeline into one indexed BAM per contig pool
+    
+    The shards are sorted in parallel, each by a single threaded samtools sort, with the
+    sort memory for the task shared between them.  The shard layout is written to
+    outfile when all shards are complete.
+    """
+    outputDir = os.path.dirname(outfile)
+    files = shard_files(shards)
+    mem = max(32 << 20, int(sort_threads) * parse_memory(sort_memory) // len(files))
+    sort = [executables['samtools'], "sort", "-m", "{}K".format(mem >> 10)]
+    index_after = not executables.supports('samtools', 'sort', '--write-index')
+    if not index_after:
+        sort.append("--write-index")
+    if benchmark_mode:
+        sort.append("--no-PG")
+    sort = ' '.join(shlex.quote(x) for x in sort)
+    map_file = outfile + '.map'
+    with open(map_file, 'w') as f:
+        for ctg, bam in shards['contigs'].items():
+            f.write("{}\t{}\n".format(ctg, bam))
+    split = ['awk', '-v', 'map={}'.format(map_file), '-v', 'other={}'.format(shards['other']), '-v', 'sort={}'.format(sort),
+             '-v', 'tmp={}'.format(os.path.join(tmpDir, name + '_shard')), shard_split]
+    process = run_tools(tools + [split], name="bisulfite-mapping", logfile=logfile)
+    if process.wait() != 0:
+        raise ValueError("Error while executing the Bisulfite bisulphite-mapping")
+    os.remove(map_file)
+    if index_after:
+        for bam in files:
+            process = run_tools([[executables['samtools'],"index","-c",bam]], name="BAM index", logfile=os.path.join(outputDir,"bam_index_{}.err".format(name)))
+            if process.wait() != 0:
+                raise ValueError("Error while indexing the BAM file")
+    tmp = outfile + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(shards, f, indent=2)
+    os.replace(tmp, outfile)
+    return os.path.abspath("%s" % outfile)
+
+def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benchmark_mode=False, greference=None, combine=False):
     """ Merge bam alignment files 
     
         inputs -- Dictionary of samples and bam list files inputs(Key=sample, Value = [bam1,...,bamN])
+                  (pool shards files are replaced by their BAM files)
         threads -- Number of threads to perform the merging process
         outname -- output file for the result
         tmpDir -- Temporary directory to perform sorting operations
+        combine -- Combine the @RG and @PG headers with the same IDs (needed for chunks of the same dataset)
     """     
     return_info = {}
     
@@ -843,7 +1309,12 @@ def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benc
 
     return_info = []
     if inputs:
-        bammerging.extend([executables['samtools'],"merge","--write-index"])
+        bammerging.extend([executables['samtools'],"merge"])
+        if combine:
+            bammerging.extend(["-c", "-p"])
+        write_index = executables.supports('samtools', 'merge', '--write-index')
+        if write_index:
+            bammerging.append("--write-index")
         if benchmark_mode:
             bammerging.append("--no-PG")
         if bam_filename.endswith('.cram'):
@@ -853,18 +1324,28 @@ def merging(inputs=None,sample=None,threads="1",outname=None,tmpDir="/tmp/",benc
         else:
             bammerging.extend(['--threads', threads]);
             
-        bammerging.extend(["-f",bam_filename])
-        for bamFile in inputs:
-            bammerging.append(bamFile)
+        bams = expand_bams(inputs)
+        # The md5 sum is computed as the merged BAM is written
+        md5 = MD5Writer(bam_filename, md5_filename)
+        bammerging.extend(["-f",md5.path] + bams)
         logfile = os.path.join(output,"bam_merge_{}.err".format(sample))
-        process = run_tools([bammerging], name="bisulphite-merging",output=bam_filename,logfile=logfile)
-        if process.wait() != 0: raise ValueError("Error while merging.")
+        process = run_tools([bammerging], name="bisulphite-merging",logfile=logfile)
+        ok = process.wait() == 0
+        if not md5.close(ok) or not ok: raise ValueError("Error while merging.")
+        if not write_index:
+            indexing = [executables['samtools'],"index"]
+            if not bam_filename.endswith('.cram'):
+                indexing.append("-c")
+            process = run_tools([indexing + [bam_filename]], name="BAM index",
+                                logfile=os.path.join(output,"bam_index_{}.err".format(sample)))
+            if process.wait() != 0: raise ValueError("Error while indexing merged BAM.")
         return_info.append(os.path.abspath(bam_filename))
-    
-    md5sum = ['md5sum',bam_filename]
-    processMD5 = run_tools([md5sum],name="BAM MD5",output=md5_filename)
-    if processMD5.wait() != 0:
-        raise ValueError("Error while calculating md5sum of BAM file.")
+    elif not (os.path.exists(md5_filename) and os.path.getmtime(md5_filename) >= os.path.getmtime(bam_filename)):
+        # The md5 sum is normally written with the BAM by mapping()
+        md5sum = ['md5sum',bam_filename]
+        processMD5 = run_tools([md5sum],name="BAM MD5",output=md5_filename)
+        if processMD5.wait() != 0:
+            raise ValueError("Error while calculating md5sum of BAM file.")
 
     return_info.append(os.path.abspath(index_filename))
     
@@ -894,12 +1375,58 @@ class BsCaller:
         self.contig_size = contig_size
         self.csizes = csizes
         self.benchmark_mode = benchmark_mode
-
-    def prepare(self, sample, input_bam, chrom_list, output_bcf, report_file, contig_bed):
+        self.read_counts = {}
+        self.lock = th.Lock()
+
+    def input_bams(self, inputs, chrom_list):
+        """BAM files with the reads for chrom_list.  inputs is a BAM file or a list of
+        BAM files and/or shards files (see pool_shards()), in which case only the shards
+        covering chrom_list are used"""
+        if not isinstance(inputs, list):
+            return [inputs]
+        bams = []
+        for f in inputs:
+            if f.endswith('.shards'):
+                shards = read_shards(f)
+                for x in chrom_list:
+                    bam = shards['contigs'].get(parse_region(x)[0], shards['other'])
+                    if not bam in bams:
+                        bams.append(bam)
+            elif not f in bams:
+                bams.append(f)
+        return bams
+
+    def covered_contigs(self, input_bam, chrom_list):
+        """Remove contigs with no mapped reads in input_bam (according to the BAM index) from
+        chrom_list.  If the index can not be read then chrom_list is returned unchanged.
+        input_bam can be a list of inputs (see input_bams())"""
+        total = {}
+        for bam in self.input_bams(input_bam, chrom_list):
+            self.lock.acquire()
+            if not bam in self.read_counts:
+                try:
+                    self.read_counts[bam] = bam_mapped_reads(bam)
+                except (OSError, ValueError, struct.error) as e:
+                    logging.warning("Could not read index stats for {}: {}".format(bam, e))
+                    self.read_counts[bam] = None
+            counts = self.read_counts[bam]
+            self.lock.release()
+            if counts == None:
+                return chrom_list
+            for ctg, n in counts.items():
+                total[ctg] = total.get(ctg, 0) + n
+        return [x for x in chrom_list if total.get(parse_region(x)[0], 1) > 0]
+
+    def prepare(self, sample, input_bam, chrom_list, output_bcf, report_file, contig_bed, threads=None):
 
         with open(contig_bed, "w") as f:
             for chrom in chrom_list:
-                f.write("{}\t0\t{}\n".format(chrom, str(self.contig_size[chrom])))
+                # Pools can contain regions (shards) of large contigs
+                ctg, start, end = parse_region(chrom)
+                if start == None:
+                    f.write("{}\t0\t{}\n".format(ctg, str(self.contig_size[ctg])))
+                else:
+                    f.write("{}\t{}\t{}\n".format(ctg, start - 1, end))
                         
         parameters_bscall = ['%s' %(executables["bs_call"]),'-r',self.reference,'-n',sample,'--contig-bed',contig_bed,'--contig-sizes',self.csizes,'--report-file',report_file]
     
@@ -928,114 +1455,227 @@ class BsCaller:
         if self.bq_threshold != None:
             parameters_bscall.extend(['--bq-threshold', self.bq_threshold])
         # Threads
-        parameters_bscall.extend(['-t', self.call_threads])
+        parameters_bscall.extend(['-t', threads if threads != None else self.call_threads])
         # dbSNP
         if self.dbSNP_index_file:
             parameters_bscall.extend(['-D', self.dbSNP_index_file])
         # Output
         parameters_bscall.extend(['-O', 'b', '-o', output_bcf]);
         
-        # Input BAM file
-        
-        parameters_bscall.append(input_bam);
+        # Input BAM file.  Several inputs (i.e., pool shards from each dataset) are merged
+        # on the fly, selecting the pool regions if samtools merge supports a region file.
+        # Otherwise a single region is selected with -R; pools of several contigs are then
+        # only called from shards, which hold just the contigs of the pool (MethylationCall
+        # refuses dataset BAMs in this case)
+        bams = self.input_bams(input_bam, chrom_list)
+        bsCall = []
+        if len(bams) > 1:
+            merge = [executables['samtools'], 'merge', '-u', '-c', '-p']
+            if executables.supports('samtools', 'merge', '-L'):
+                merge.extend(['-L', contig_bed])
+            elif len(chrom_list) == 1:
+                merge.extend(['-R', chrom_list[0]])
+            bsCall.append(merge + ['-'] + bams)
+            bams = ['-']
+        parameters_bscall.append(bams[0]);
     
-        bsCall = [parameters_bscall]
+        bsCall.append(parameters_bscall)
         return bsCall
 
 class MethylationCallIter:
+    # The calling tasks are read from the db once and kept in a heap (samples in order,
+    # largest pools first).  Tasks are claimed from the db with a single transaction for
+    # all of the threads that are idle, so no more tasks are held than can be started.
+    # Completions are recorded as soon as each task finishes
     def __init__(self, samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db):
         self.sample_bam = sample_bam
         self.sample_list = samples
         self.output_bcf = output_bcf
-        self.sample_ix = 0
-        self.pool_ix = 0
-        self.output_list = []
+        self.jobs = max(1, jobs)
+        # Tasks handed to threads and not yet finished
+        self.active = 0
+        self.output_list = set()
         self.plist = {}
         self.concat = concat
         self.no_merge = no_merge
         self.ignore_db = ignore_db
         self.status = {}
+        self.loaded = False
+        self.queue = []
+        self.claimed = collections.deque()
+        self.done = []
+        self.sample_ix = {}
+        self.sample_of = {}
+        self.pool_files = {}
+        self.mrg_file = {}
+        self.pending = {}
+        self.waiting = set()
         
-        for smp in self.sample_list:
+        for ix, smp in enumerate(self.sample_list):
             self.plist[smp] = {}
+            self.sample_ix[smp] = ix
+            self.pool_files[smp] = []
+            self.pending[smp] = 0
         for smp, pl in output_bcf.items():
             for v in pl:
-                self.output_list.append(v[0])
+                self.output_list.add(v[0])
                 self.plist[smp][v[1]] = v
 
     def __iter__(self):
         return  self
 
     def __next__(self):
-        db = database()
+        if not self.claimed:
+            self.claim()
+        if not self.claimed:
+            raise StopIteration
+        self.active += 1
+        return self.claimed.popleft()
+
+    def load(self, c):
+        for fname, pool, sample, psize, ftype, status in c.execute("SELECT filepath, poolid, sample, poolsize, type, status FROM calling ORDER BY poolsize DESC").fetchall():
+            if sample not in self.sample_ix:
+                continue
+            if self.ignore_db:
+                status = 0
+            self.status[fname] = status
+            self.sample_of[fname] = sample
+            if ftype == 'POOL_BCF':
+                self.pool_files[sample].append(fname)
+                if status == 0:
+                    self.push_pool(fname, sample, pool, psize)
+            elif ftype == 'MRG_BCF':
+                self.mrg_file[sample] = fname
+                if status == 0 and not self.no_merge:
+                    self.waiting.add(sample)
+        self.loaded = True
+
+    def push_pool(self, fname, sample, pool, psize):
+        if fname in self.output_list and not self.concat:
+            heapq.heappush(self.queue, (self.sample_ix[sample], 0, -psize, fname, ('POOL_BCF', sample, pool)))
+            self.pending[sample] += 1
+
+    def merge_inputs(self, sample):
+        # Returns the list of pool BCFs to merge if the sample is ready to be merged,
+        # otherwise None
+        if self.status.get(self.mrg_file.get(sample), -1) != 0:
+            return None
+        list_bcfs = []
+        for fname in self.pool_files[sample]:
+            status = self.status[fname]
+            if status == 0 and fname in self.output_list and self.concat:
+                continue
+            if status != 1:
+                return None
+            list_bcfs.append(fname)
+        return list_bcfs
+
+    def refresh(self, c, sample):
+        # Pick up changes made by other gemBS processes for a sample that is
+        # not waiting on any of our tasks
+        for fname, pool, smp, psize, ftype, status in database.backend.rows(c, 'calling', sample):
+            old = self.status.get(fname)
+            self.status[fname] = status
+            if ftype == 'POOL_BCF' and status == 0 and old != 0:
+                self.push_pool(fname, sample, pool, psize)
+
+    def record_done(self, c):
+        for fname, bcf_list in self.done:
+            database.backend.finish(c, 'calling', fname, 1)
+            if bcf_list != None:
+                for f in bcf_list:
+                    database.backend.finish(c, 'calling', f, 2)
+
+    def claim(self):
+        db = database.connection()
         db.isolation_level = None
         c = db.cursor()
-        try_get_exclusive(c)
-        ret = None
-        for sample in self.sample_list:
-            mrg_file = ""
-            mrg_ok = False if self.no_merge else True
-            list_bcfs = []
-            for fname, pool, ftype, status in c.execute("SELECT filepath, poolid, type, status FROM calling WHERE sample = ? ORDER BY poolsize DESC", (sample,)):
-                if self.ignore_db:
-                    status = self.status.get(fname, 0)
-                if ftype == 'POOL_BCF':
-                    if fname in self.output_list and status == 0:
-                        if not self.concat:
-                            ret = (ftype, sample, self.sample_bam[sample], self.plist[sample][pool])
-                            c.execute("UPDATE calling SET status = 3 WHERE filepath = ?", (fname,))
-                            self.status[fname] = 1
-                            base, ext = os.path.splitext(fname)
-                            jfile = base + '.json'
-                            database.reg_db_com(fname, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(fname), [fname, jfile])
-                            break
-                    elif status != 1:
-                        mrg_ok = False
-                    else:
-                        list_bcfs.append(fname)
-                elif ftype == 'MRG_BCF':
-                    if status == 0:
-                        mrg_file = fname
-                    else:
-                        mrg_ok = False
+        begin_immediate(c)
+        if not self.loaded:
+            self.load(c)
+        for sample in sorted(self.waiting, key = lambda x: self.sample_ix[x]):
+            if self.pending[sample] > 0:
+                continue
+            list_bcfs = self.merge_inputs(sample)
+            if list_bcfs == None and not self.ignore_db:
+                self.refresh(c, sample)
+                if self.pending[sample] > 0:
+                    continue
+                list_bcfs = self.merge_inputs(sample)
+            if list_bcfs != None:
+                mrg_file = self.mrg_file[sample]
+                heapq.heappush(self.queue, (self.sample_ix[sample], 1, 0, mrg_file, ('MRG_BCF', sample, list_bcfs)))
+                self.pending[sample] += 1
+                self.waiting.discard(sample)
+        # Claim a task for each thread that is idle (including the caller)
+        batch_size = max(1, self.jobs - self.active)
+        while self.queue and len(self.claimed) < batch_size:
+            fname, task = heapq.heappop(self.queue)[3:]
+            ftype, sample = task[:2]
+            self.pending[sample] -= 1
+            status = 0
+            if not self.ignore_db:
+                c.execute("SELECT status FROM calling WHERE filepath = ?", (fname,))
+                ret = c.fetchone()
+                status = ret[0] if ret else -1
+            if status == 0 and not database.backend.claim(c, 'calling', fname):
+                c.execute("SELECT status FROM calling WHERE filepath = ?", (fname,))
+                status = c.fetchone()[0]
+            if status != 0:
+                # Claimed by another process
+                self.status[fname] = status
+                if ftype == 'MRG_BCF' and status == 3:
+                    self.waiting.add(sample)
+                continue
+            self.status[fname] = 3
+            self.pending[sample] += 1
+            if ftype == 'POOL_BCF':
+                base, ext = os.path.splitext(fname)
+                jfile = base + '.json'
+                database.reg_db_com(fname, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(fname), [fname, jfile], ('calling', 3), c)
+                self.claimed.append((ftype, sample, self.sample_bam[sample], self.plist[sample][task[2]]))
             else:
-                if mrg_ok and mrg_file != "":
-                    c.execute("UPDATE calling SET status = 3 WHERE filepath = ?", (mrg_file,))
-                    self.status[mrg_file] = 1
-                    ixfile = mrg_file + '.csi'
-                    md5file = mrg_file + '.md5'
-                    database.reg_db_com(mrg_file, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(mrg_file), [mrg_file, ixfile, md5file])
-                    ret = ('MRG_BCF', sample, mrg_file, list_bcfs)
-            if ret != None:
-                break
+                ixfile = fname + '.csi'
+                md5file = fname + '.md5'
+                database.reg_db_com(fname, "UPDATE calling SET status = 0 WHERE filepath = '{}'".format(fname), [fname, ixfile, md5file], ('calling', 3), c)
+                self.claimed.append((ftype, sample, fname, task[2]))
         c.execute("COMMIT")
-        db.close()
-        if ret == None:
-            raise StopIteration
-        else:
-            return ret
+        db.isolation_level = 'DEFERRED'
 
     def finished(self, bcf_list, fname):
-        db = database()
-        db.isolation_level = None
-        c = db.cursor()
-        try_get_exclusive(c)
-        c.execute("UPDATE calling SET status = 1 WHERE filepath = ?", (fname,))
+        # The db is updated straight away, so a completed task is not reset if
+        # gemBS is stopped before the other tasks finish
         if bcf_list != None:
             for f in bcf_list:
                 if os.path.exists(f): os.remove(f)
-                c.execute("UPDATE calling SET status = 2 WHERE filepath = ?", (f,))
-        c.execute("COMMIT")
-        database.del_db_com(fname)
-        db.close()
+                self.status[f] = 2
+        self.status[fname] = 1
+        self.pending[self.sample_of[fname]] -= 1
+        self.active -= 1
+        self.done.append((fname, bcf_list))
+        self.flush()
+
+    def flush(self):
+        if self.done:
+            db = database.connection()
+            db.isolation_level = None
+            c = db.cursor()
+            begin_immediate(c)
+            self.record_done(c)
+            c.execute("COMMIT")
+            db.isolation_level = 'DEFERRED'
+            for fname, bcf_list in self.done:
+                database.del_db_com(fname)
+            self.done = []
           
 class MethylationCallThread(th.Thread):
-    def __init__(self, threadID, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode):
+    def __init__(self, threadID, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode, scheduler):
         th.Thread.__init__(self)
         self.threadID = threadID
         self.methIter = methIter
         self.bsCall = bsCall
         self.lock = lock
+        self.scheduler = scheduler
         self.remove = remove
         self.dry_run_com = dry_run_com
         self.dry_run_json = dry_run_json
@@ -1044,16 +1684,25 @@ class MethylationCallThread(th.Thread):
         self.conversion = conversion
         self.sample_conversion = sample_conversion
         self.benchmark_mode = benchmark_mode
+        self.error = None
 
     def run(self):
+        # An error stops this thread, and is raised by methylationCalling() when all
+        # threads have finished
+        try:
+            self.do_tasks()
+        except Exception as e:
+            self.error = e
+
+    def do_tasks(self):
         while True:
             self.lock.acquire()
             try:
                 ret = self.methIter.__next__()
-                self.lock.release()
             except StopIteration:
-                self.lock.release()
                 break
+            finally:
+                self.lock.release()
             if ret[0] == 'POOL_BCF':
                 (sample, input_bam, pool) = ret[1:]
                 bcf_file, pool, chrom_list = pool
@@ -1080,19 +1729,29 @@ class MethylationCallThread(th.Thread):
                         task['command']=com
                         task['sample_barcode']=sample
                         task['pool']=pool
-                        task['inputs']=[input_bam]
+                        task['inputs']=input_bam if isinstance(input_bam, list) else [input_bam]
                         task['outputs']=[bcf_file, report_file, log_file]
                         desc="call {} {}".format(sample,pool)
                         self.json_commands[desc]=task
                 else:
-                    contig_bed = os.path.join(output,"contigs_{}_{}.bed".format(sample, pool))
-                    bsCallCommand = self.bsCall.prepare(sample, input_bam, chrom_list, bcf_file, report_file, contig_bed)
-                    process = run_tools(bsCallCommand, name="bscall", logfile=log_file)
-                    if process.wait() != 0:
-                        raise ValueError("Error while executing the bscall process.")
-                self.lock.acquire()
-                self.methIter.finished(None, bcf_file)
-                self.lock.release()
+                    chrom_list = self.bsCall.covered_contigs(input_bam, chrom_list)
+                    if not chrom_list:
+                        # No reads on any contig in the pool, so we write an empty stub BCF
+                        # (skipped by bsConcat) rather than running bs_call
+                        logging.gemBS.gt("No reads for sample {} on contig pool {}".format(sample, pool))
+                        open(bcf_file, 'w').close()
+                    else:
+                        contig_bed = os.path.join(output,"contigs_{}_{}.bed".format(sample, pool))
+                        grant = self.scheduler.acquire('call')
+                        try:
+                            bsCallCommand = self.bsCall.prepare(sample, input_bam, chrom_list, bcf_file, report_file, contig_bed, threads=str(grant.threads))
+                            process = run_tools(bsCallCommand, name="bscall", logfile=log_file)
+                            if process.wait() != 0:
+                                raise ValueError("Error while executing the bscall process.")
+                        finally:
+                            self.scheduler.release(grant)
+                with self.lock:
+                    self.methIter.finished(None, bcf_file)
             else:
                 (sample, fname, list_bcfs) = ret[1:]
                 if self.dry_run_com:
@@ -1116,26 +1775,30 @@ class MethylationCallThread(th.Thread):
                         self.json_commands[desc]=task
                 
                 else:
-                    bsConcat(list_bcfs, sample, self.bsCall.merge_threads, fname, self.benchmark_mode)
-                    self.lock.acquire()
-                    if self.remove:
-                        self.methIter.finished(list_bcfs, fname)
-                    else:
-                        self.methIter.finished(None, fname)
-                    self.lock.release()
+                    grant = self.scheduler.acquire('bcf_merge')
+                    try:
+                        bsConcat(list_bcfs, sample, str(grant.threads), fname, self.benchmark_mode)
+                    finally:
+                        self.scheduler.release(grant)
+                    with self.lock:
+                        if self.remove:
+                            self.methIter.finished(list_bcfs, fname)
+                        else:
+                            self.methIter.finished(None, fname)
                 
                 
 def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=None,samples=None,right_trim=0,left_trim=5,dry_run_com=None,
                        keep_unmatched=False,keep_duplicates=False,dbSNP_index_file="",call_threads="1",merge_threads="1",jobs=1,remove=False,concat=False,
                        mapq_threshold=None,bq_threshold=None,haploid=False,conversion=None,ref_bias=None,sample_conversion=None,
-                       no_merge=False,json_commands=None,dry_run=False,dry_run_json=None,ignore_db=None,ignore_duplicates=False,benchmark_mode=False):
+                       no_merge=False,json_commands=None,dry_run=False,dry_run_json=None,ignore_db=None,ignore_duplicates=False,benchmark_mode=False,
+                       scheduler=None,call_memory=None):
 
     """ Performs the process to make met5Bhylation calls.
     
     reference -- fasta reference file
     species -- species name
     sample -- list of samples for processing
-    sample_bam -- sample dictionary where key is sample and value is bam aligned file 
+    sample_bam -- sample dictionary where key is sample and value is bam aligned file (or list of pool shards files)
     output_bcf -- sample dictionary where key is sample and value is list of tuples (output file, pool, list of contigs in pool)
     right_trim --  Bases to trim from right of read pair 
     left_trim -- Bases to trim from left of read pair
@@ -1154,6 +1817,8 @@ def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=No
     ref_bias -- bias to reference homozygote
     sample_conversion - per sample conversion rates (calculated if conversion == 'auto')
     benchmark_mode - remove version and date information from header
+    scheduler - ResourceScheduler used to admit the calling and merging tasks (default: whole node)
+    call_memory - memory required by each calling task
     """
 
     for snp, pl in output_bcf.items():
@@ -1188,13 +1853,25 @@ def methylationCalling(reference=None,species=None,sample_bam=None,output_bcf=No
     methIter = MethylationCallIter(samples, sample_bam, output_bcf, jobs, concat, no_merge, ignore_db)
     lock = th.Lock()
     if jobs < 1: jobs = 1
+    # The number of jobs is only an upper limit on the number of parallel tasks;
+    # each task is admitted by the scheduler against the node budget
+    if scheduler == None:
+        scheduler = ResourceScheduler()
+    # A task keeps its threads for its whole run, so it is not started with less than
+    # half of the requested threads
+    scheduler.declare('call', threads=call_threads, min_threads=(int(call_threads) + 1) // 2, memory=call_memory)
+    scheduler.declare('bcf_merge', threads=merge_threads)
     thread_list = []
     for ix in range(jobs):
-        thread = MethylationCallThread(ix, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode)
+        thread = MethylationCallThread(ix, methIter, bsCall, lock, remove, dry_run_com, dry_run, dry_run_json, json_commands, conversion, sample_conversion, benchmark_mode, scheduler)
         thread.start()
         thread_list.append(thread)
     for thread in thread_list:
         thread.join()
+    methIter.flush()
+    for thread in thread_list:
+        if thread.error != None:
+            raise thread.error
     return " ".join(list(sample_bam.keys()))
 
             
@@ -1285,36 +1962,40 @@ def bsConcat(list_bcfs=None,sample=None,threads=None,bcfSample=None,benchmark_mo
     bcfSampleMd5 = os.path.join(output_dir,"{}.bcf.md5".format(sample))
     logfile = os.path.join(output_dir,"bcf_concat_{}.err".format(sample))
    
-    #Concatenation
-    concat = [executables['bcftools'],'concat','-O','b','-n','-o',bcfSample]
-    if threads != None:
+    # Skip stub BCFs for pools with no reads
+    list_bcfs = [x for x in list_bcfs if os.path.getsize(x) > 0]
+    if not list_bcfs:
+        raise ValueError("No calls found for sample {}".format(sample))
+    # Shards of a contig must be concatenated in order of position
+    list_bcfs.sort(key = bcf_sort_key)
+
+    #Concatenation (the md5 sum is computed as the output is written)
+    md5 = MD5Writer(bcfSample, bcfSampleMd5)
+    concat = [executables['bcftools'],'concat','-O','b','-n','-o',md5.path]
+    if threads != None and executables.supports('bcftools', 'concat', '--threads'):
         concat.extend(['--threads', threads])
+    # Recent bcftools can write the index during the concatenation
+    write_index = executables.supports('bcftools', 'concat', '--write-index')
+    if write_index:
+        concat.append('--write-index')
     if benchmark_mode:
         concat.append('--no-version')
-    list_bcfs.sort()
     concat.extend(list_bcfs)
      
     process = run_tools([concat],name="Concatenation Calls",logfile=logfile)
-    if process.wait() != 0:
+    ok = process.wait() == 0
+    if not md5.close(ok) or not ok:
         raise ValueError("Error while concatenating bcf calls.")
         
     #Indexing
-    indexing = [executables['bcftools'],'index']
-    if threads != None:
-        indexing.extend(['--threads', threads])
-    indexing.append(bcfSample)
-
-    #md5sum
-    md5sum = ['md5sum',bcfSample]
-
-    processIndex = run_tools([indexing],name="Index BCF")
-    processMD5 = run_tools([md5sum],name="Index MD5",output=bcfSampleMd5)
-    
-    if processIndex.wait() != 0:
-        raise ValueError("Error while Indexing BCF file.")        
-                
-    if processMD5.wait() != 0:
-        raise ValueError("Error while calculating md5sum of merged BCF file.")
+    if not write_index:
+        indexing = [executables['bcftools'],'index']
+        if threads != None:
+            indexing.extend(['--threads', threads])
+        indexing.append(bcfSample)
+        processIndex = run_tools([indexing],name="Index BCF")
+        if processIndex.wait() != 0:
+            raise ValueError("Error while Indexing BCF file.")        
         
     return os.path.abspath(bcfSample)
     
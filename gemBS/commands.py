@@ -1,14 +1,14 @@
 #!/usr/bin/env python
 """gemBS commands"""
 import argparse
-import pkg_resources
 import os
 import sys
 
 from argparse import RawTextHelpFormatter
-from .utils import CommandException
+from .utils import CommandException, package_resource
 from .production import *
 from .database import database
+from . import executables
 
 
 LOG_NOTHING = 1
@@ -97,14 +97,14 @@ def gemBS_main():
         parser.add_argument('-j', '--json-file', dest="json", help="Location of gemBS JSON file")
         parser.add_argument('-d', '--dir', dest="wd", metavar="DIR",help="Set working directory")
         
-        if pkg_resources.resource_exists("gemBS", "bin"):
-            f = pkg_resources.resource_filename("gemBS", "bin")
-        path = os.environ.get("PATH")
-        if path == None:
-            path = f
-        else:
-            path = f + ":" + path
-            os.environ["PATH"] = path
+        f = package_resource("bin")
+        if f != None:
+            path = os.environ.get("PATH")
+            if path == None:
+                path = f
+            else:
+                path = f + ":" + path
+                os.environ["PATH"] = path
             
         commands = {
             "prepare" : PrepareConfiguration,            
@@ -114,6 +114,7 @@ def gemBS_main():
             "call" : MethylationCall,
             "merge-bcfs" : BsCallConcatenate,
             "extract": MethylationFiltering,
+            "run" : Run,
             "map-report" : MappingReports,
             "call-report" : VariantsReports,
             "db-sync": dbSync
@@ -147,6 +148,9 @@ def gemBS_main():
                     break
 
         BasicPipeline.gemBS_json = args.json
+        # Keep resolved executables and tool probes between runs
+        if os.path.isdir('.gemBS'):
+            executables.set_cache(os.path.join('.gemBS', 'executables.json'))
         if args.command == None:
             parser.print_help(sys.stderr)
         else:
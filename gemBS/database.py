@@ -4,8 +4,12 @@ import re
 import fnmatch
 import logging
 import json
+import struct
+import socket
+import hashlib
+import time
 import threading as th
-from .utils import CommandException
+from .utils import CommandException, parse_region, shard_contig, bam_mapped_reads, StatCache, begin_immediate
 
 ## Global register for db commands that must be performed if
 ## processes are aborted
@@ -14,8 +18,36 @@ class database(sqlite3.Connection):
     db_name = None
     json_data = None
     _mem_db = False
+    _snapshot = False
     _db_com_register = {}
     _lock = th.Lock()
+    _local = th.local()
+    _journal_mode = 'wal'
+    _journal_set = False
+    # Seconds that a connection waits for a lock held by another connection
+    busy_timeout = 60
+    # Seconds without a heartbeat after which a claimed task can be reclaimed
+    lease_timeout = 600
+    _leases = {}
+    _leases_written = set()
+    _heartbeat = None
+    _heartbeat_event = th.Event()
+    _host = socket.gethostname()
+    # Version of the db schema (stored as the user_version of the db).  The commands in
+    # _migrations[v] bring a db at version v - 1 up to version v
+    schema_version = 2
+    _migrations = {
+        1: (
+            "CREATE INDEX IF NOT EXISTS mapping_fileid ON mapping (fileid, status)",
+            "CREATE INDEX IF NOT EXISTS mapping_sample ON mapping (sample)",
+            "CREATE INDEX IF NOT EXISTS calling_sample ON calling (sample, poolsize DESC)",
+            "CREATE INDEX IF NOT EXISTS calling_status ON calling (type, status)",
+            "CREATE INDEX IF NOT EXISTS extract_sample ON extract (sample)"
+        ),
+        2: (
+            "CREATE TABLE IF NOT EXISTS leases (filepath text PRIMARY KEY, tab text, status int, host text, pid int, start real, heartbeat real, com text, files text)",
+        )
+    }
     
     @classmethod
     def setup(cls, json_data):
@@ -23,24 +55,149 @@ class database(sqlite3.Connection):
         config = cls.json_data.config
         cls.db_name = config['DEFAULT'].get('gembs_dbfile', 'file:gemBS?mode=memory&cache=shared')
         cls._mem_db = (cls.db_name.startswith('file:'))
+        cls._snapshot = False
+        mode = str(config['DEFAULT'].get('db_journal_mode', 'wal')).lower()
+        if not mode in ('wal', 'delete', 'truncate', 'persist'):
+            raise CommandException("Unknown db_journal_mode '{}'".format(mode))
+        cls._journal_mode = mode
+        cls._journal_set = False
+        cls.lease_timeout = float(config['DEFAULT'].get('lease_timeout', cls.lease_timeout))
+        backend = str(config['DEFAULT'].get('state_backend', 'sqlite')).lower()
+        if backend == 'files':
+            # The task state is shared through marker files, so each process works from
+            # an in memory db built from the output files
+            cls.db_name = 'file:gemBS?mode=memory&cache=shared'
+            cls._mem_db = True
+            cls.backend = FileBackend.get(config['DEFAULT'].get('state_dir', '.gemBS/state'))
+        elif backend == 'sqlite':
+            cls.backend = SqliteBackend()
+        else:
+            raise CommandException("Unknown state_backend '{}'".format(backend))
         
     @classmethod
     def mem_db(cls):
         return cls._mem_db
+
+    @classmethod
+    def check_files(cls, sync = False):
+        # The status of the output files has to be checked on the filesystem when syncing and
+        # with an in memory db, unless that is a snapshot of the disk db (which is up to date)
+        return sync or (cls._mem_db and not cls._snapshot)
+
+    @classmethod
+    def connection(cls):
+        # Returns the db connection for the calling thread, opening it on first use.  The
+        # connection is kept open for the lifetime of the thread, so it must not be closed
+        db = getattr(cls._local, 'db', None)
+        if db == None or db.db_file != cls.db_name:
+            db = database()
+            cls._local.db = db
+        return db
     
     @classmethod
-    def reg_db_com(cls, key, com, rm_list):
-        cls._lock.acquire()
-        if key in cls._db_com_register:
-            raise CommandException("Can not register duplicate key")
-        cls._db_com_register[key] = (com, rm_list)
-        cls._lock.release()
+    def reg_db_com(cls, key, com, rm_list, lease = None, c = None):
+        # If lease (the table and status of the claimed row) is given, the claim is recorded
+        # in the leases table and kept alive by a background heartbeat, so that the task can
+        # be reclaimed by another process if this one dies without running cleanup_db_com.
+        # The lease is written with c, the cursor of the transaction making the claim, so
+        # a claim is never in the db without its lease
+        with cls._lock:
+            if key in cls._db_com_register:
+                raise CommandException("Can not register duplicate key")
+            cls._db_com_register[key] = (com, rm_list, lease[0] if lease != None else None)
+            if lease != None and cls.backend.uses_leases():
+                now = time.time()
+                cls._leases[key] = (lease[0], lease[1], now)
+                if c != None and not cls._mem_db:
+                    c.execute("REPLACE INTO leases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, lease[0], lease[1], cls._host, os.getpid(), now, now, com, json.dumps(rm_list)))
+                    cls._leases_written.add(key)
+                if cls._heartbeat == None:
+                    cls._heartbeat = th.Thread(target = cls._heartbeat_loop, daemon = True)
+                    cls._heartbeat.start()
+                cls._heartbeat_event.set()
 
     @classmethod
     def del_db_com(cls, key):
-        cls._lock.acquire()
-        del cls._db_com_register[key]
-        cls._lock.release()
+        with cls._lock:
+            del cls._db_com_register[key]
+            cls._leases.pop(key, None)
+
+    @classmethod
+    def _heartbeat_loop(cls):
+        while True:
+            cls._heartbeat_event.clear()
+            try:
+                cls.backend.heartbeat()
+            except sqlite3.Error as e:
+                logging.warning("Could not update task leases: {}".format(e))
+            cls._heartbeat_event.wait(max(1, cls.lease_timeout / 10))
+
+    @classmethod
+    def update_leases(cls):
+        # Write new leases, renew the heartbeat of the leases we hold, remove the leases of
+        # tasks we have finished and reclaim expired leases of other processes
+        now = time.time()
+        pid = os.getpid()
+        with cls._lock:
+            leases = {}
+            for key, v in cls._leases.items():
+                leases[key] = v + cls._db_com_register[key][:2]
+            written = set(cls._leases_written)
+        db = database.connection()
+        db.isolation_level = None
+        c = db.cursor()
+        begin_immediate(c)
+        for key, (tab, status, start, com, rm_list) in leases.items():
+            if key in written:
+                c.execute("UPDATE leases SET heartbeat = ? WHERE filepath = ? AND host = ? AND pid = ?", (now, key, cls._host, pid))
+                if c.rowcount == 0:
+                    logging.warning("Lease on {} has been reclaimed by another process".format(key))
+            else:
+                c.execute("REPLACE INTO leases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (key, tab, status, cls._host, pid, start, now, com, json.dumps(rm_list)))
+        removed = written.difference(leases)
+        for key in removed:
+            c.execute("DELETE FROM leases WHERE filepath = ? AND host = ? AND pid = ?", (key, cls._host, pid))
+        with cls._lock:
+            # Leases written with their claim since we looked are kept
+            cls._leases_written = (cls._leases_written - removed) | set(leases)
+        database.reclaim_leases(c, now)
+        c.execute("COMMIT")
+        db.isolation_level = 'DEFERRED'
+
+    @classmethod
+    def reclaim_leases(cls, c, now = None):
+        # Reclaim tasks whose lease has expired, or that were claimed by a process on this
+        # host that no longer exists.  The task is only reset if its row still has the
+        # claimed status (i.e., it was not finished before the lease was removed)
+        if now == None:
+            now = time.time()
+        pid = os.getpid()
+        expired = []
+        for key, tab, status, host, lpid, heartbeat, com, files in c.execute("SELECT filepath, tab, status, host, pid, heartbeat, com, files FROM leases").fetchall():
+            if host == cls._host:
+                if lpid == pid:
+                    continue
+                try:
+                    os.kill(lpid, 0)
+                    alive = True
+                except ProcessLookupError:
+                    alive = False
+                except OSError:
+                    alive = True
+                if alive and heartbeat > now - cls.lease_timeout:
+                    continue
+            elif heartbeat > now - cls.lease_timeout:
+                continue
+            expired.append((key, tab, status, com, files))
+        for key, tab, status, com, files in expired:
+            c.execute("SELECT status FROM {} WHERE filepath = ?".format(tab), (key,))
+            ret = c.fetchone()
+            if ret and ret[0] == status:
+                logging.gemBS.gt("Reclaiming abandoned task {}".format(key))
+                c.execute(com)
+                for f in json.loads(files):
+                    if os.path.exists(f): os.remove(f)
+            c.execute("DELETE FROM leases WHERE filepath = ?", (key,))
 
     @classmethod
     def cleanup_db_com(cls):
@@ -50,19 +207,37 @@ class database(sqlite3.Connection):
                 for key, v in cls._db_com_register.items():
                     db.isolation_level = None
                     c = db.cursor()
-                    c.execute("BEGIN EXCLUSIVE")
+                    c.execute("BEGIN IMMEDIATE")
                     c.execute(v[0])
+                    if v[2] != None:
+                        cls.backend.reset(c, v[2], key)
                     c.execute("COMMIT")
                     if v[1]:
                         for f in v[1]:
                             if os.path.exists(f): os.remove(f)
+                    cls.backend.release(key)
+                if cls._leases_written:
+                    db.isolation_level = None
+                    c = db.cursor()
+                    c.execute("BEGIN IMMEDIATE")
+                    c.execute("DELETE FROM leases WHERE host = ? AND pid = ?", (cls._host, os.getpid()))
+                    c.execute("COMMIT")
                 db.close()
             else:
+                # The markers of the state backend are reset as well as the in memory db
+                db = database()
+                c = db.cursor()
                 for key, v in cls._db_com_register.items():
                     if v[1]:
                         for f in v[1]:
                             if os.path.exists(f): os.remove(f)
+                    if v[2] != None:
+                        cls.backend.reset(c, v[2], key)
+                    cls.backend.release(key)
+                db.commit()
+                db.close()
             cls._db_com_register = {}
+            cls._leases = {}
                
 
     def __init__(self, json_data = None, sync = False):
@@ -70,16 +245,43 @@ class database(sqlite3.Connection):
         if json_data != None:
             database.setup(json_data)
             newdb = True
+        self.db_file = database.db_name
         if database._mem_db:
-            sqlite3.Connection.__init__(self, database.db_name, uri = True, timeout = 5)
+            sqlite3.Connection.__init__(self, database.db_name, uri = True, timeout = database.busy_timeout)
             if newdb:
                 self.create_tables()
                 self.check()
         else:
-            sqlite3.Connection.__init__(self, database.db_name)
+            sqlite3.Connection.__init__(self, database.db_name, timeout = database.busy_timeout)
+            self.set_journal_mode()
             if sync:
                 self.create_tables()
                 self.check(sync)
+            elif newdb:
+                # Bring dbs made by older versions up to the current schema
+                self.create_tables()
+            if newdb or sync:
+                c = self.cursor()
+                begin_immediate(c)
+                self.reclaim_leases(c)
+                self.commit()
+
+    def set_journal_mode(self):
+        # With WAL journaling readers are not blocked while a status update is written.
+        # WAL needs shared memory so it is not available on some network filesystems, in
+        # which case sqlite keeps the existing rollback journal
+        if not database._journal_set:
+            database._journal_set = True
+            try:
+                ret = self.execute("PRAGMA journal_mode = {}".format(database._journal_mode)).fetchone()
+                mode = ret[0].lower() if ret else None
+            except sqlite3.OperationalError as e:
+                mode = None
+                logging.debug("Could not set journal mode of {}: {}".format(database.db_name, e))
+            if mode != database._journal_mode:
+                logging.debug("Journal mode of {} is {}".format(database.db_name, mode))
+        if database._journal_mode == 'wal':
+            self.execute("PRAGMA synchronous = NORMAL")
             
     def create_tables(self):
         c = self.cursor()
@@ -88,38 +290,92 @@ class database(sqlite3.Connection):
         c.execute("CREATE TABLE IF NOT EXISTS calling (filepath test PRIMARY KEY, poolid text, sample text, poolsize int, type text, status int)")
         c.execute("CREATE TABLE IF NOT EXISTS extract (filepath test PRIMARY KEY, sample text, status int)")
         self.commit()
+        self.migrate()
+
+    def migrate(self):
+        c = self.cursor()
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version > database.schema_version:
+            raise CommandException("db file '{}' has schema version {} which is newer than this version of gemBS ({})".format(database.db_name, version, database.schema_version))
+        for v in range(version + 1, database.schema_version + 1):
+            logging.debug("Updating db schema to version {}".format(v))
+            for com in database._migrations[v]:
+                c.execute(com)
+            c.execute("PRAGMA user_version = {}".format(v))
+        self.commit()
 
     def copy_to_mem(self):
+        # Changes to the copy are local to this process, so claims are made in the db only
+        database.backend = SqliteBackend()
         # Don't bother if we are already in memory
         if not database._mem_db:
             # close existing connection
             self.close()
             # re-open connection to disk db
             oldname = database.db_name
-            db = sqlite3.connect(oldname)
+            db = sqlite3.connect(oldname, timeout = database.busy_timeout)
             # sswitch to in memory db
             database.db_name = 'file:gemBS?mode=memory&cache=shared'
             database._mem_db = True
+            database._snapshot = True
             self.__init__()
-            self.create_tables()
-            c_old = db.cursor()
-            c = self.cursor()
-            for tab in ('indexing', 'mapping', 'calling', 'extract'):
-                for ret in c_old.execute("SELECT * FROM {}".format(tab)):
-                    c.execute("INSERT INTO {} VALUES {}".format(tab, ret))
-            self.commit()
+            # Take a consistent snapshot of the disk db (including the indexes) in one step
+            db.backup(self)
             db.close()
+            self.create_tables()
                     
-    def check(self, sync = False):
-        self.check_index()
-        self.check_mapping(sync)
-        self.check_contigs(sync)
-        self.check_extract(sync)
+    def check(self, sync = False, samples = None):
+        # The existence of the output files is checked using one directory scan per directory.
+        # If samples (a set of sample barcodes) is given then only the entries for those
+        # samples are checked, and the existing contig pools are kept
+        stat = StatCache()
+        self.check_index(stat)
+        self.check_mapping(sync, stat, samples)
+        self.check_contigs(sync, stat, samples)
+        self.check_extract(sync, stat, samples)
+        database.backend.load(self)
+
+    # Column of the sample barcode in the task tables
+    _sample_col = {'mapping': 2, 'calling': 2, 'extract': 1}
+    
+    def update_table(self, table, new_tab, old_tab = None, samples = None, commit = True):
+        # Bring table into line with new_tab (a dict of rows keyed on filepath), only
+        # touching the rows that have changed.  old_tab has the current rows of the
+        # table, and is read from the db if not supplied.  If samples is set then
+        # rows for other samples are left alone.  If commit is False the caller ends
+        # the transaction.  Returns True if the table was changed
+        c = self.cursor()
+        if old_tab == None:
+            old_tab = {}
+            for ret in c.execute("SELECT * FROM {}".format(table)):
+                old_tab[ret[0]] = ret
+        if samples != None:
+            ix = database._sample_col[table]
+            old_tab = {key: tab for key, tab in old_tab.items() if tab[ix] in samples}
+        delete = [(key,) for key in old_tab if not key in new_tab]
+        insert = []
+        for key, tab in new_tab.items():
+            if old_tab.get(key) != tuple(tab):
+                insert.append(tab)
+        if not (delete or insert):
+            if commit:
+                self.commit()
+            return False
+        logging.debug("Updating {} table".format(table))
+        c.executemany("DELETE FROM {} WHERE filepath = ?".format(table), delete)
+        if insert:
+            c.executemany("REPLACE INTO {} VALUES ({})".format(table, ', '.join('?' * len(insert[0]))), insert)
+        if commit:
+            self.commit()
+        return True
     
-    def check_index(self):
+    def check_index(self, stat = None):
+        if stat == None:
+            stat = StatCache()
         config = database.json_data.config
         ref = config['DEFAULT']['reference']
-        if not os.path.exists(ref):
+        if not stat.exists(ref):
             raise CommandException("Reference file '{}' does not exist".format(ref))
 
         c = self.cursor()
@@ -137,7 +393,7 @@ class database(sqlite3.Connection):
                 dbSNP_idx = os.path.join(index_dir,'dbSNP_gemBS.idx')
                 config['DEFAULT']['dbsnp_index'] = dbSNP_idx
         dbSNP_ok = 0
-        if dbSNP_idx != None and os.path.exists(dbSNP_idx): dbSNP_ok = 1
+        if dbSNP_idx != None and stat.exists(dbSNP_idx): dbSNP_ok = 1
         reference_basename = cdef.get('reference_basename', None)
         if reference_basename == None:
             # No base name supplied so we derive it from input file
@@ -176,7 +432,7 @@ class database(sqlite3.Connection):
                 contig_md5 = index + '.gemBS.contig_md5'
         if index == None:
             index = os.path.join(index_dir, reference_basename) + '.BS.gem'
-            index_ok = 1 if os.path.exists(index) else 0
+            index_ok = 1 if stat.exists(index) else 0
         else:
             try:
                 index = database._prepare_index_parameter(index)
@@ -186,16 +442,16 @@ class database(sqlite3.Connection):
         if nonbs_index == None:
             if nonbs_flag:
                 nonbs_index = os.path.join(index_dir, reference_basename) + '.gem'
-                nonbs_index_ok = 1 if os.path.exists(index) else 0
+                nonbs_index_ok = 1 if stat.exists(index) else 0
         else:
             try:
                 nonbs_index = database._prepare_index_parameter(nonbs_index, nonbs = True)
                 nonbs_index_ok = 1
             except IOError:
                 nonbs_index_ok = 0
-        csizes_ok = 1 if os.path.exists(csizes) else 0
-        greference_ok = 1 if os.path.exists(greference) and os.path.exists(greference + '.fai') and os.path.exists(greference + '.gzi') else 0
-        contig_md5_ok = 1 if os.path.exists(contig_md5) else 0
+        csizes_ok = 1 if stat.exists(csizes) else 0
+        greference_ok = 1 if stat.exists(greference) and stat.exists(greference + '.fai') and stat.exists(greference + '.gzi') else 0
+        contig_md5_ok = 1 if stat.exists(contig_md5) else 0
         c.execute("REPLACE INTO indexing VALUES (?, 'index', ?)",(index, index_ok))
         c.execute("REPLACE INTO indexing VALUES (?, 'contig_sizes', ?)",(csizes,csizes_ok))
         c.execute("REPLACE INTO indexing VALUES (?, 'gembs_reference', ?)",(greference,greference_ok))
@@ -210,7 +466,9 @@ class database(sqlite3.Connection):
             c.execute("DELETE FROM indexing WHERE type == 'dbsnp_idx'")
         self.commit()
 
-    def check_mapping(self, sync = False):
+    def check_mapping(self, sync = False, stat = None, samples = None):
+        if stat == None:
+            stat = StatCache()
         js = database.json_data
         config = js.config
         sdata = js.sampleData
@@ -226,67 +484,76 @@ class database(sqlite3.Connection):
             mapfile_suffix = 'cram'
         else:
             mapfile_suffix = 'bam'
+        # Datasets can be split into chunks that are mapped separately (not possible for streamed input)
+        map_chunks = int(config['mapping'].get('map_chunks', 1))
+        no_chunks = ('STREAM', 'SINGLE_STREAM', 'PAIRED_STREAM', 'COMMAND', 'SINGLE_COMMAND', 'PAIRED_COMMAND')
+        chunks = lambda k: map_chunks if map_chunks > 1 and not sdata[k].type in no_chunks else 1
+        # Mapping tasks can write one BAM per contig pool (listed in a .shards file) so that
+        # calling can start without waiting for the merge
+        shard_flag = config['mapping'].get('map_pool_shards', None)
+        if shard_flag != None:
+            shard_flag = json.loads(str(shard_flag).lower())
+        else:
+            shard_flag = False
+        ind_suffix = 'shards' if shard_flag else 'bam'
+        # If merge_bams is False then calling reads directly from the dataset BAMs, and no
+        # sample BAM is made for samples with several datasets (or chunks)
+        merge_flag = config['mapping'].get('merge_bams', None)
+        if merge_flag != None:
+            merge_flag = json.loads(str(merge_flag).lower())
+        else:
+            merge_flag = True
             
         c = self.cursor()
-        slist = {}
-        for k, v in sdata.items():
-            bc = v.sample_barcode
-            if not bc in slist: 
-                slist[bc] = [k]
-            else:
-                slist[bc].append(k)
+        slist = js.sample_datasets
+        if samples != None:
+            slist = {bc: fli for bc, fli in slist.items() if bc in samples}
 
         old_tab = {}
-        key_used = {}
         if not sync:
             for ret in c.execute("SELECT * FROM mapping"):
                 old_tab[ret[0]] = ret
-                key_used[ret[0]] = False
+    
+        if database.check_files(sync):
+            dirs = []
+            for bc, fli in slist.items():
+                dirs.append(bam_dir.replace('@BARCODE', bc).replace('@SAMPLE', sdata[fli[0]].sample_name))
+            stat.scan(dirs)
     
         mapping_tab = {}
-        changed = False
         for bc, fli in slist.items():
             sample = sdata[fli[0]].sample_name
             bam = bam_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample)
             sample_bam = os.path.join(bam, "{}.{}".format(bc, mapfile_suffix))
-            key_used[sample_bam] = True
             old = old_tab.get(sample_bam, (0,0,0,0,0))
-            if database._mem_db or sync:
-                if os.path.isfile(sample_bam):
+            if database.check_files(sync):
+                if stat.isfile(sample_bam):
                     old = (0,0,0,0,1)
-            if len(fli) > 1:
-                mapping_tab[sample_bam] = (sample_bam, '', bc, 'MRG_BAM', old[4])
+            if len(fli) > 1 or chunks(fli[0]) > 1 or shard_flag:
+                if merge_flag:
+                    mapping_tab[sample_bam] = (sample_bam, '', bc, 'MRG_BAM', old[4])
                 for k in fli:
-                    ind_bam = os.path.join(bam, "{}.bam".format(k))
-                    old1 = old_tab.get(ind_bam, (0,0,0,0,0))
-                    if database._mem_db or sync:
-                        if os.path.isfile(ind_bam):
-                            old1 = (0,0,0,0,1)                    
-                        elif old[4] == 1:
-                            old1 = (0,0,0,0,2)
-                    mapping_tab[ind_bam] = (ind_bam, k, bc, 'MULTI_BAM', old1[4])
-                    key_used[ind_bam] = True
-                    if old1 != mapping_tab[ind_bam]:
-                        changed = True
+                    n = chunks(k)
+                    if n > 1:
+                        bams = [(os.path.join(bam, "{}.chunk{}of{}.{}".format(k, i, n, ind_suffix)), 'CHUNK_BAM') for i in range(1, n + 1)]
+                    else:
+                        bams = [(os.path.join(bam, "{}.{}".format(k, ind_suffix)), 'MULTI_BAM')]
+                    for ind_bam, ftype in bams:
+                        old1 = old_tab.get(ind_bam, (0,0,0,0,0))
+                        if database.check_files(sync):
+                            if stat.isfile(ind_bam):
+                                old1 = (0,0,0,0,1)                    
+                            elif merge_flag and old[4] == 1:
+                                old1 = (0,0,0,0,2)
+                        mapping_tab[ind_bam] = (ind_bam, k, bc, ftype, old1[4])
             else:
                 mapping_tab[sample_bam] = (sample_bam, fli[0], bc, 'SINGLE_BAM', old[4])
-            if old != mapping_tab[sample_bam]:
-                changed = True
-
-        if not changed:
-            for k, s in key_used.items():
-                if not s:
-                    changed = True
-                    break
-            
-        if changed:
-            logging.debug("Updating mapping table")
-            c.execute("DELETE FROM mapping")
-            for key, tab in mapping_tab.items():
-                c.execute("INSERT INTO mapping VALUES(?, ?, ?, ?, ?)", tab)
-            self.commit()
 
-    def check_contigs(self, sync = False):
+        self.update_table('mapping', mapping_tab, None if sync else old_tab, samples)
+
+    def check_contigs(self, sync = False, stat = None, samples = None, commit = True):
+        if stat == None:
+            stat = StatCache()
 
         # First get list of contigs
         c = self.cursor()
@@ -307,6 +574,7 @@ class database(sqlite3.Connection):
     
         sdata = js.sampleData
         pool_size = int(config['calling'].get('contig_pool_limit', '25000000'))
+        shard_size = int(config['calling'].get('contig_shard_size', '0'))
         omit = config['calling'].get('omit_contigs', [])
         ctg_req_list = config['calling'].get('contig_list', [])
         ctg_pools = {}
@@ -321,11 +589,24 @@ class database(sqlite3.Connection):
         for ctg in contig_size:
             ctg_flag[ctg] = [0, None]
 
+        # Expected work for each contig - this is used to balance the pools and to order
+        # the calling (largest first).  By default the work is the contig length.  The
+        # coverage based plan is only used with a disk db (or a snapshot of one), as an
+        # in memory db is rebuilt by each process and the plan would not be kept
+        ctg_work = contig_size
+        if config['calling'].get('pool_balance', 'length') == 'coverage' and not database.check_files():
+            ctg_work = self.contig_work(contig_size)
+        def region_work(reg):
+            ctg, start, end = parse_region(reg)
+            if start == None:
+                return ctg_work[ctg]
+            return ctg_work[ctg] * (end - start + 1) // contig_size[ctg]
         
         # Make list of contig pools already described in JSON file
         rebuild = 0;
         for pool, ctglist in js.contigs.items():
-            for ctg in ctglist:
+            for reg in ctglist:
+                ctg = parse_region(reg)[0]
                 if ctg not in contig_size:
                     rebuild |= 1
                 else:
@@ -334,15 +615,19 @@ class database(sqlite3.Connection):
             ctg_pools[pool] = [ctglist, False, {}]
             
         # And make list of contigs already completed in table
+        old_tab = None
         if not sync:
-            for fname, pool, smp, psize, ftype, status in c.execute("SELECT * FROM calling"):
+            old_tab = {}
+            for ret in c.execute("SELECT * FROM calling"):
+                old_tab[ret[0]] = ret
+                fname, pool, smp, psize, ftype, status = ret
                 if ftype == 'POOL_BCF' and status != 0:
                     if pool in ctg_pools:
                         v = ctg_pools[pool]
                         v[1] = True
                         v[2][smp] = status
-                        for ctg in v[0]:
-                            ctg_flag[ctg][0] |= 2
+                        for reg in v[0]:
+                            ctg_flag[parse_region(reg)[0]][0] |= 2
                     else:
                         rebuild |= 2
                 else:
@@ -360,15 +645,37 @@ class database(sqlite3.Connection):
             logging.gemBS.gt("db tables have been altered and do not correspond - rebuilding")
             for ctg in contig_size:
                 ctg_flag[ctg] = [0, None]
+            # The pools change, so the entries for all samples must be rebuilt
+            samples = None
         else:
+            # Keep pools that have been started for any sample.  If one shard of a
+            # contig has been started then all shards of the contig are kept.  When
+            # only some samples are being checked all of the existing pools are kept
             for pool, v in ctg_pools.items():
-                if v[1]:
-                    pool_size = 0
-                    for ctg in v[0]:
-                        pool_size += contig_size[ctg]
-                    pool_list.append((pool, v[0], pool_size))
+                keep = v[1] or samples != None
+                psize = 0
+                for reg in v[0]:
+                    ctg, start, end = parse_region(reg)
+                    psize += region_work(reg)
+                    if start != None and ctg_flag[ctg][0] & 2: keep = True
+                if keep:
+                    for reg in v[0]:
+                        ctg_flag[parse_region(reg)[0]][0] |= 2
+                    pool_list.append((pool, v[0], psize))
                     pools_used[pool] = True
 
+        # Contigs larger than contig_shard_size (if set) are split into regions
+        # that are called as separate pools
+        def add_contig(ctg, sz):
+            shards = shard_contig(ctg, sz, shard_size) if shard_size > 0 else []
+            if len(shards) > 1:
+                for pl, reg in shards:
+                    pool_list.append((pl, [reg], region_work(reg)))
+                    pools_used[pl] = True
+            else:
+                pool_list.append((ctg, [ctg], ctg_work[ctg]))
+                pools_used[ctg] = True
+
         # Handle requested list
         # Two passes - first pass to check if any requested contigs have already been processed for some samples
         # Second pass to add the remaining requested contigs as individual pools
@@ -382,8 +689,7 @@ class database(sqlite3.Connection):
                     req_list1.append(pl)
         for ctg in ctg_req_list:
             if (ctg_flag[ctg][0] & 2) == 0:
-                pool_list.append((ctg, [ctg]))
-                pools_used[ctg] = True
+                add_contig(ctg, contig_size[ctg])
                 ctg_flag[ctg] = [3, ctg]
                 req_list1.append(ctg)
         for ctg, sz in contig_size.items():
@@ -392,7 +698,7 @@ class database(sqlite3.Connection):
                     small_contigs.append(ctg)
                     total_small += sz
                 else:
-                    pool_list.append((ctg, [ctg], sz))
+                    add_contig(ctg, sz)
                 
         if small_contigs:
             k = (total_small // pool_size) + 1
@@ -404,45 +710,91 @@ class database(sqlite3.Connection):
                 while pname(ix) in pools_used: ix += 1
                 pools.append([pname(ix), [], 0])
                 ix += 1
-            for ctg in sorted(small_contigs, key = lambda x: (-contig_size[x], ctg)):
+            for ctg in sorted(small_contigs, key = lambda x: (-ctg_work[x], x)):
                 pl = sorted(pools, key = lambda x: (x[2], x[0]))[0]
-                sz = contig_size[ctg]
+                sz = ctg_work[ctg]
                 pl[1].append(ctg)
                 pl[2] = pl[2] + sz
             for pl in pools:
                 pool_list.append((pl[0], pl[1], pl[2]))
         bc_list = {}
-        for k, v in sdata.items():
-            bc_list[v.sample_barcode] = v.sample_name
-        c.execute("DELETE FROM calling")
+        for bc, fli in js.sample_datasets.items():
+            if samples == None or bc in samples:
+                bc_list[bc] = sdata[fli[0]].sample_name
+        if database.check_files(sync):
+            stat.scan([bcf_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample) for bc, sample in bc_list.items()])
+        calling_tab = {}
         js.pools = {}
         js.contigs = {}
         for bc,sample in bc_list.items():
             bcf = bcf_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample)
             bcf_file = os.path.join(bcf, "{}.bcf".format(bc, ))
             st = mrg_list.get(bc, 0)
-            if database._mem_db or sync:
-                if os.path.isfile(bcf_file): st = 1            
-            c.execute("INSERT INTO calling VALUES (?, ?, ?, ?, 'MRG_BCF', ?)", (bcf_file, '' , bc, 0, st))
+            if database.check_files(sync):
+                if stat.isfile(bcf_file): st = 1            
+            calling_tab[bcf_file] = (bcf_file, '' , bc, 0, 'MRG_BCF', st)
             for pl in pool_list:
                 bcf_file = os.path.join(bcf, "{}_{}.bcf".format(bc, pl[0]))
                 if pl[0] in ctg_pools:
                     v = ctg_pools[pl[0]][2]
                     st1 = v.get(bc, 0)
-                    if database._mem_db or sync:
-                        if os.path.isfile(bcf_file): st1 = 1
+                    if database.check_files(sync):
+                        if stat.isfile(bcf_file): st1 = 1
                         elif st == 1: st1 = 2
                 else:
                     st1 = 0
-                c.execute("INSERT INTO calling VALUES (?, ?, ?, ?, 'POOL_BCF', ?)", (bcf_file, pl[0], bc, pl[2], st1))
+                calling_tab[bcf_file] = (bcf_file, pl[0], bc, pl[2], 'POOL_BCF', st1)
         for pl in pool_list:
             js.contigs[pl[0]] = []
-            for ctg in pl[1]:
-                js.contigs[pl[0]].append(ctg)
-                js.pools[ctg]=pl[0]
-        self.commit()
+            for reg in pl[1]:
+                js.contigs[pl[0]].append(reg)
+                js.pools[parse_region(reg)[0]]=pl[0]
+        self.update_table('calling', calling_tab, old_tab, samples, commit)
+        # The state backend could still have markers for pools that are new (or that
+        # have been rebuilt) from an earlier plan, which would make them look finished.
+        # The merged BCFs of the samples with these pools are also reset if not present
+        reset = [key for key, pool, bc, psize, ftype, st in calling_tab.values() if ftype == 'POOL_BCF' and st == 0 and (rebuild != 0 or not pool in ctg_pools)]
+        if reset:
+            reset_samples = set(calling_tab[key][2] for key in reset)
+            reset.extend(key for key, pool, bc, psize, ftype, st in calling_tab.values() if ftype == 'MRG_BCF' and st == 0 and bc in reset_samples)
+            for key in reset:
+                database.backend.reset(c, 'calling', key)
+            if commit:
+                self.commit()
 
-    def check_extract(self, sync = False):
+    def contig_work(self, contig_size):
+        # Estimate the work for each contig from the number of reads mapped to the
+        # contig in the sample BAMs that are available.  The counts are taken from the
+        # BAM indexes and scaled so that the total work is equal to the total length of
+        # the contigs (so the contig_pool_limit keeps its meaning).  If no counts are
+        # available the contig lengths are used.
+        c = self.cursor()
+        reads = {}
+        for (bam,) in c.execute("SELECT filepath FROM mapping WHERE type NOT IN ('MULTI_BAM', 'CHUNK_BAM') AND status = 1").fetchall():
+            try:
+                counts = bam_mapped_reads(bam)
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning("Could not read index stats for {}: {}".format(bam, e))
+                counts = None
+            if counts == None:
+                continue
+            for ctg, n in counts.items():
+                reads[ctg] = reads.get(ctg, 0) + n
+        total_reads = 0
+        total_size = 0
+        for ctg, sz in contig_size.items():
+            total_reads += reads.get(ctg, 0)
+            total_size += sz
+        if total_reads == 0:
+            return contig_size
+        ctg_work = {}
+        for ctg in contig_size:
+            ctg_work[ctg] = max(1, reads.get(ctg, 0) * total_size // total_reads)
+        return ctg_work
+        
+    def check_extract(self, sync = False, stat = None, samples = None):
+        if stat == None:
+            stat = StatCache()
         js = database.json_data
         config = js.config
         sdata = js.sampleData
@@ -450,49 +802,34 @@ class database(sqlite3.Connection):
 
         c = self.cursor()
         slist = {}
-        for k, v in sdata.items():
-            bc = v.sample_barcode
-            if not bc in slist: 
-                slist[bc] = v.sample_name
+        for bc, fli in js.sample_datasets.items():
+            if samples == None or bc in samples:
+                slist[bc] = sdata[fli[0]].sample_name
 
         old_tab = {}
-        key_used = {}
         if not sync:
             for ret in c.execute("SELECT * FROM extract"):
                 old_tab[ret[0]] = ret
-                key_used[ret[0]] = False
+
+        if database.check_files(sync):
+            stat.scan([cpg_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample) for bc, sample in slist.items()])
 
         extract_tab = {}
-        changed = False
         for bc, sample in slist.items():
             cpg = cpg_dir.replace('@BARCODE', bc).replace('@SAMPLE', sample)
             sample_cpg = os.path.join(cpg, bc)
-            key_used[sample_cpg] = True
             old = old_tab.get(sample_cpg, ("","",0))
-            if database._mem_db or sync:
+            if database.check_files(sync):
                 st = 0
-                if os.path.isfile(sample_cpg + '_cpg.txt.gz.tbi'): st |= 1
-                if os.path.isfile(sample_cpg + '_non_cpg.txt.gz.tbi'): st |= 4
-                if os.path.isfile(sample_cpg + '_chh.bb'): st |= 16
-                if os.path.isfile(sample_cpg + '.bw'): st |= 64
-                if os.path.isfile(sample_cpg + '_snps.txt.gz.tbi'): st |= 256
+                if stat.isfile(sample_cpg + '_cpg.txt.gz.tbi'): st |= 1
+                if stat.isfile(sample_cpg + '_non_cpg.txt.gz.tbi'): st |= 4
+                if stat.isfile(sample_cpg + '_chh.bb'): st |= 16
+                if stat.isfile(sample_cpg + '.bw'): st |= 64
+                if stat.isfile(sample_cpg + '_snps.txt.gz.tbi'): st |= 256
                 old = (old[0], old[1], st)
             extract_tab[sample_cpg] = (sample_cpg, bc, old[2])
-            if old != extract_tab[sample_cpg]:
-                changed = True
-
-        if not changed:
-            for k, s in key_used.items():
-                if not s:
-                    changed = True
-                    break
-            
-        if changed:
-            logging.debug("Updating extract table")
-            c.execute("DELETE FROM extract")
-            for key, tab in extract_tab.items():
-                c.execute("INSERT INTO extract VALUES(?, ?, ?)", tab)
-            self.commit()
+
+        self.update_table('extract', extract_tab, None if sync else old_tab, samples)
 
     @staticmethod
     def _prepare_index_parameter(index, nonbs = False):
@@ -522,3 +859,263 @@ class database(sqlite3.Connection):
 
         return index
 
+
+class SqliteBackend:
+    """Task state kept in the sqlite db (the default).  The callers make the
+    claims inside an IMMEDIATE transaction, so the db lock ensures that only
+    one process can claim a task.
+    """
+    def uses_leases(self):
+        return not database._mem_db
+
+    def heartbeat(self):
+        database.update_leases()
+
+    def load(self, db):
+        pass
+
+    def claim(self, c, tab, key, status = 3):
+        """Claim the task for key, returning False if it can not be claimed"""
+        c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (status, key))
+        return True
+
+    def finish(self, c, tab, key, status = 1):
+        """Record the final status for key"""
+        c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (status, key))
+
+    def reset(self, c, tab, key):
+        """Return key to the not started state"""
+        c.execute("UPDATE {} SET status = 0 WHERE filepath = ?".format(tab), (key,))
+
+    def release(self, key):
+        """Drop a claim held by this process without changing the db (used on abort)"""
+        pass
+
+    def rows(self, c, tab, sample = None):
+        """List the rows of tab (optionally only for one sample) with their current status"""
+        if sample == None:
+            return c.execute("SELECT * FROM {}".format(tab)).fetchall()
+        return c.execute("SELECT * FROM {} WHERE sample = ?".format(tab), (sample,)).fetchall()
+
+class FileBackend(SqliteBackend):
+    """Task state kept in marker files so that processes on filesystems without
+    reliable locking can share work without a common db lock.
+
+    Each process uses an in memory db built from the output files.  A task is
+    claimed by creating <state_dir>/<table>/<sample>/<id>.claim with
+    O_CREAT|O_EXCL, and on completion <id>.done.<status> is moved into place with
+    rename before the claim is removed.  Claims are kept alive by touching the
+    claim file; a claim that has not been touched for lease_timeout seconds (or
+    whose process on this host has died) is broken by renaming it away.
+    """
+    _instances = {}
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        self.held = {}
+        self.base = {}
+        self.lock = th.Lock()
+
+    @classmethod
+    def get(cls, state_dir):
+        # One backend per state_dir for the process, so the claims held are not lost
+        # when the db is set up again
+        key = os.path.abspath(state_dir)
+        with database._lock:
+            if not key in cls._instances:
+                cls._instances[key] = cls(state_dir)
+            return cls._instances[key]
+
+    def uses_leases(self):
+        return True
+
+    def heartbeat(self):
+        with self.lock:
+            claims = list(self.held.values())
+        for path in claims:
+            try:
+                os.utime(path)
+            except OSError as e:
+                logging.warning("Could not update claim {}: {}".format(path, e))
+
+    def load(self, db):
+        c = db.cursor()
+        for tab in ('mapping', 'calling', 'extract'):
+            self.rows(c, tab)
+        db.commit()
+
+    def _path(self, c, tab, key):
+        c.execute("SELECT sample FROM {} WHERE filepath = ?".format(tab), (key,))
+        ret = c.fetchone()
+        sample = ret[0] if ret else ''
+        return os.path.join(self.state_dir, tab, sample), self._ident(key)
+
+    @staticmethod
+    def _ident(key):
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def _scan(self, dname):
+        # Returns a dict with the done status and claim file (if present) for each id
+        markers = {}
+        try:
+            with os.scandir(dname) as it:
+                for entry in it:
+                    fd = entry.name.split('.')
+                    if len(fd) == 2 and fd[1] == 'claim':
+                        markers.setdefault(fd[0], [None, None])[1] = entry.path
+                    elif len(fd) == 3 and fd[1] == 'done':
+                        markers.setdefault(fd[0], [None, None])[0] = int(fd[2])
+        except OSError:
+            pass
+        return markers
+
+    def _stale(self, path, st = None):
+        try:
+            with open(path, 'r') as f:
+                info = json.load(f)
+            mtime = (st if st != None else os.stat(path)).st_mtime
+        except (OSError, ValueError):
+            return False
+        if info.get('host') == database._host and info.get('pid') != os.getpid():
+            try:
+                os.kill(info['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except OSError:
+                pass
+        return mtime < time.time() - database.lease_timeout
+
+    def _claim_status(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f).get('status', 3)
+        except (OSError, ValueError):
+            return 3
+
+    def _create_claim(self, path, status):
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if attempt == 0 and self._stale(path, st):
+                    # Only one process can succeed in renaming the stale claim away, but
+                    # the claim could have been broken and re-made by another process
+                    # since it was checked, so make sure that it is the same file
+                    stale = "{}.{}.{}.stale".format(path, database._host, os.getpid())
+                    try:
+                        os.rename(path, stale)
+                    except OSError:
+                        continue
+                    try:
+                        st1 = os.stat(stale)
+                        if (st1.st_ino, st1.st_mtime) != (st.st_ino, st.st_mtime):
+                            self._restore_claim(stale, path)
+                            return False
+                        os.remove(stale)
+                        logging.gemBS.gt("Reclaiming abandoned task {}".format(path))
+                    except OSError:
+                        pass
+                    continue
+                return False
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'host': database._host, 'pid': os.getpid(), 'start': time.time(), 'status': status}, f)
+            return True
+        return False
+
+    @staticmethod
+    def _restore_claim(stale, path):
+        # Put back a live claim that was renamed away.  A link is used so that a claim
+        # made in the meantime by another process is not overwritten
+        try:
+            os.link(stale, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            # No hard links on this filesystem
+            os.rename(stale, path)
+            return
+        os.remove(stale)
+
+    def _update(self, c, tab, key, markers, ident):
+        # Status of key from the markers: a done marker takes precedence, then a live
+        # claim by another process.  A stale claim without a done marker means the task
+        # was not finished, whatever output files it left
+        c.execute("SELECT status FROM {} WHERE filepath = ?".format(tab), (key,))
+        ret = c.fetchone()
+        if ret == None or key in self.held:
+            return
+        base = self.base.setdefault(key, ret[0])
+        done, claim = markers.get(ident, (None, None))
+        if done != None:
+            status = done
+        elif claim != None:
+            status = 0 if self._stale(claim) else self._claim_status(claim)
+        else:
+            status = base
+        if status != ret[0]:
+            c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (status, key))
+
+    def claim(self, c, tab, key, status = 3):
+        dname, ident = self._path(c, tab, key)
+        os.makedirs(dname, exist_ok = True)
+        path = os.path.join(dname, ident + '.claim')
+        if not self._create_claim(path, status):
+            c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (self._claim_status(path), key))
+            return False
+        # Check that the task was not finished by another process since we last looked
+        c.execute("SELECT status FROM {} WHERE filepath = ?".format(tab), (key,))
+        old = c.fetchone()[0]
+        done = self._scan(dname).get(ident, (None, None))[0]
+        if done != None and done != old:
+            c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (done, key))
+            os.remove(path)
+            return False
+        with self.lock:
+            self.held[key] = path
+        c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (status, key))
+        return True
+
+    def finish(self, c, tab, key, status = 1):
+        dname, ident = self._path(c, tab, key)
+        os.makedirs(dname, exist_ok = True)
+        base = os.path.join(dname, ident)
+        tmp = "{}.{}.{}.tmp".format(base, database._host, os.getpid())
+        open(tmp, 'w').close()
+        os.rename(tmp, "{}.done.{}".format(base, status))
+        for entry in os.scandir(dname):
+            if entry.name.startswith(ident + '.done.') and entry.name != "{}.done.{}".format(ident, status):
+                os.remove(entry.path)
+        c.execute("UPDATE {} SET status = ? WHERE filepath = ?".format(tab), (status, key))
+        self.release(key)
+
+    def reset(self, c, tab, key):
+        dname, ident = self._path(c, tab, key)
+        if os.path.isdir(dname):
+            for entry in os.scandir(dname):
+                if entry.name.startswith(ident + '.done.'):
+                    os.remove(entry.path)
+        c.execute("UPDATE {} SET status = 0 WHERE filepath = ?".format(tab), (key,))
+        self.release(key)
+
+    def release(self, key):
+        with self.lock:
+            path = self.held.pop(key, None)
+        if path != None and os.path.exists(path):
+            os.remove(path)
+
+    def rows(self, c, tab, sample = None):
+        if sample == None:
+            samples = [x[0] for x in c.execute("SELECT DISTINCT sample FROM {}".format(tab)).fetchall()]
+        else:
+            samples = [sample]
+        for smp in samples:
+            markers = self._scan(os.path.join(self.state_dir, tab, smp))
+            for (key,) in c.execute("SELECT filepath FROM {} WHERE sample = ?".format(tab), (smp,)).fetchall():
+                self._update(c, tab, key, markers, self._ident(key))
+        return SqliteBackend.rows(self, c, tab, sample)
+
+database.backend = SqliteBackend()
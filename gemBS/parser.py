@@ -1,8 +1,8 @@
 import shlex
 import re
 import os
-import pkg_resources
 import logging
+from .utils import package_resource
 
 class gembsConfigLex(shlex.shlex):
     def __init__(self, instream = None, infile = None, config_dir = None):
@@ -34,8 +34,8 @@ class gembsConfigParse:
     def __init__(self):
         self.reg = re.compile("[$][{]([^}]+)[}]")
         self.reg1 = re.compile("([^:]+)[:](.*)")
-        if pkg_resources.resource_exists("gemBS", "etc/gemBS_configs"):
-            self.sys_config_dir = pkg_resources.resource_filename("gemBS", "etc/gemBS_configs")
+        if package_resource("etc/gemBS_configs") != None:
+            self.sys_config_dir = package_resource("etc/gemBS_configs")
         
     def read(self, infile):
         f = open(infile,'r')
@@ -133,16 +133,20 @@ class gembsConfigParse:
                     state = 0
                     
         known_var = {
+            'default': ('gembs_dbfile', 'db_journal_mode', 'lease_timeout', 'state_backend', 'state_dir'),
             'mapping': ('tmp_dir', 'threads', 'non_stranded', 'reverse_conversion', 'remove_individual_bams',
                         'underconversion_sequence', 'overconversion_sequence', 'bam_dir', 'sequence_dir', 'benchmark_mode',
-                        'make_cram', 'map_threads', 'sort_threads', 'merge_threads', 'sort_memory'),
+                        'make_cram', 'map_threads', 'sort_threads', 'merge_threads', 'sort_memory', 'jobs', 'max_cores', 'max_memory',
+                        'map_chunks', 'map_pool_shards', 'merge_bams', 'merge_jobs'),
             'index': ('index', 'index_dir', 'reference', 'extra_references', 'reference_basename', 'nonbs_index', 'contig_sizes',
                       'threads', 'dbsnp_files', 'dbsnp_index', 'sampling_rate', 'populate_cache'),
             'calling': ('bcf_dir', 'mapq_threshold', 'qual_threshold', 'left_trim', 'right_trim', 'threads', 'jobs', 'species',
                         'keep_duplicates', 'keep_improper_pairs', 'call_threads', 'merge_threads',
-                        'remove_individual_bcfs', 'haploid', 'reference_bias', 'conversion', 'contig_list', 'contig_pool_limit', 'benchmark_mode'),
+                        'remove_individual_bcfs', 'haploid', 'reference_bias', 'conversion', 'contig_list', 'contig_pool_limit', 'contig_shard_size', 'pool_balance', 'benchmark_mode',
+                        'call_memory', 'max_cores', 'max_memory'),
             'extract': ('extract_dir', 'jobs', 'allow_het', 'phred_threshold', 'min_inform', 'strand_specific', 'min_bc', 'make_cpg', 'make_non_cpg',
-                        'make_bedmethyl', 'bigwig_strand_specific', 'make_bigwig', 'make_snps', 'snp_list', 'snp_db', 'reference_bias', 'threads', 'extract_threads'),
+                        'make_bedmethyl', 'bigwig_strand_specific', 'make_bigwig', 'make_snps', 'snp_list', 'snp_db', 'reference_bias', 'threads', 'extract_threads',
+                        'extract_memory', 'max_cores', 'max_memory'),
             'report': ('project', 'report_dir', 'threads')
         }
         # Check if variables are used
@@ -1,22 +1,21 @@
 #!/usr/bin/env python
 """Production pipelines"""
 import os
-import re
 import fnmatch
 import logging
 import json
 import sys
+import argparse
 import time
 import datetime
 from sys import exit
 import subprocess
 import threading as th
 
-from .utils import Command, CommandException, try_get_exclusive
-from .reportStats import LaneStats,SampleStats
-from .report import buildReport as htmlBuildReport
-from .sphinx import buildReport as sphinxBuildReport
-from .bsCallReports import *
+from .utils import Command, CommandException, begin_immediate, ResourceScheduler, parse_memory, parse_region, parse_chunk, InputFileIndex
+from concurrent.futures import ThreadPoolExecutor
+# The report modules (which load matplotlib and numpy) are only imported
+# by the commands that need them to keep start up fast
 from .__init__ import *
 
 
@@ -24,6 +23,9 @@ class BasicPipeline(Command):
     """General mapping pipeline class."""
 
     gemBS_json = None
+    node_scheduler = None
+    # Project data shared by all tasks run by gemBS run
+    node_json = None
 
     def __init__(self):
         # general parameters
@@ -52,6 +54,55 @@ class BasicPipeline(Command):
         #Virtual methos, to be define in child class
         pass
 
+    def plan_pools(self):
+        """Re-plan the contig pools using the read counts from the sample BAM indexes.  This
+        is only done if calling has not yet started for any pool, as the pools must be the same
+        for all samples.  The db is locked until the new pools have been written to the JSON file"""
+        self.db.isolation_level = None
+        c = self.db.cursor()
+        begin_immediate(c)
+        try:
+            c.execute("SELECT count(*) FROM calling WHERE type = 'POOL_BCF' AND status != 0")
+            if c.fetchone()[0] == 0:
+                # Start from the pools in the JSON file in case they have been re-planned by another process
+                old_contigs = JSONdata(BasicPipeline.gemBS_json).contigs
+                self.jsonData.contigs = old_contigs
+                self.db.check_contigs(commit = False)
+                if self.jsonData.contigs != old_contigs:
+                    logging.gemBS.gt("Contig pools re-planned using BAM index statistics")
+                    self.jsonData.write()
+            c.execute("COMMIT")
+        except:
+            c.execute("ROLLBACK")
+            raise
+        finally:
+            self.db.isolation_level = 'DEFERRED'
+
+    def resource_scheduler(self, section):
+        """Make a scheduler for the node budget given by the max_cores and max_memory
+        configuration keys (by default all cores and physical memory of the node).
+        If a node wide scheduler has been set up (by gemBS run) then this is returned instead"""
+        if BasicPipeline.node_scheduler != None:
+            return BasicPipeline.node_scheduler
+        cores = self.jsonData.check(section=section,key='max_cores',arg=None,int_type=True)
+        memory = self.jsonData.check(section=section,key='max_memory',arg=None)
+        return ResourceScheduler(cores=cores, memory=memory)
+
+    def project_data(self, json_file):
+        """Load the project data from json_file.  If the project data has been loaded
+        by gemBS run then a copy of this is returned instead, as the commands update
+        the configuration from their options"""
+        if BasicPipeline.node_json != None:
+            return BasicPipeline.node_json.copy()
+        return JSONdata(json_file)
+
+    def project_db(self):
+        """Set up the db for the project data.  Under gemBS run the db has already been
+        set up, so the connection for the calling thread is returned"""
+        if BasicPipeline.node_json != None:
+            return database.connection()
+        return database(self.jsonData)
+
 
 class PrepareConfiguration(Command):
     title = "Prepare"
@@ -86,6 +137,11 @@ Input Files:
   common analysis directories (i.e., using a shared filesystem, stroing output files in the same locations) then the
   disk based database must be used to avoid interference between the different gemBS instances.
 
+  If the shared filesystem has slow or unreliable file locking, setting state_backend = files in the configuration
+  file makes the gemBS instances coordinate by creating marker files (in the directory given by state_dir, by default
+  .gemBS/state) instead of through the database.  Each instance then builds its database in memory from the output
+  files, so no database locks are required.
+
   By default the database (if used) is stored in the file .gemBS/gemBS.db and the output JSON file is stored in 
   .gemBS/gemBS.json.  If the -no-db option is set then the JSON file will be stored to the file gemBS.json in the
   current directory.  The --output option can be used to specify an alternate locationn for the JSON file and the 
@@ -94,6 +150,9 @@ Input Files:
   for the JSON file them it will be necessary to specify the location of the JSON file for each gemBS command.  It 
   is therefore advised to stay with the default option if possible.
 
+  The --append option adds the datasets in the sample file that are not already present to an existing project.  The
+  existing datasets, contig pools and the recorded state of the existing samples are left unchanged.
+
 """
                 
     def register(self, parser):
@@ -104,17 +163,18 @@ Input Files:
         parser.add_argument('-D', '--no-db', dest="no_db", action="store_true", help="Do not use disk base database.")
         parser.add_argument('-d', '--db-file', dest="dbfile", help="Specify location for database file.")
         parser.add_argument('-l', '--lims-cnag-json', dest="lims_cnag_json", help="Lims CNAG subproject JSON file.")
+        parser.add_argument('-a', '--append', dest="append", action="store_true", help="Add new datasets to an existing project.")
         
     def run(self,args):
         #Try text metadata file
         if args.text_metadata is not None:
             if os.path.isfile(args.text_metadata):
-                prepareConfiguration(text_metadata=args.text_metadata,configFile=args.config,no_db=args.no_db,dbfile=args.dbfile,output=args.output)
+                prepareConfiguration(text_metadata=args.text_metadata,configFile=args.config,no_db=args.no_db,dbfile=args.dbfile,output=args.output,append=args.append)
             else:
                 raise CommandException("File %s not found" %(args.text_metadata))
         elif args.lims_cnag_json is not None:
             if os.path.isfile(args.lims_cnag_json):
-                prepareConfiguration(lims_cnag_json=args.lims_cnag_json,configFile=args.config,no_db=args.no_db,dbfile=args.dbfile,output=args.output)
+                prepareConfiguration(lims_cnag_json=args.lims_cnag_json,configFile=args.config,no_db=args.no_db,dbfile=args.dbfile,output=args.output,append=args.append)
             else:
                 raise CommandException("File %s not found" %(args.lims_cnag_json))
         else:
@@ -236,12 +296,39 @@ class Index(BasicPipeline):
             if ret:
                 logging.gemBS.gt("Contig sizes file done: {}".format(ret))
                 db.check()
-                jdict = jsonData.jsconfig
-                jdict['contigs'] = jsonData.contigs
-                with open(Index.gemBS_json, 'w') as of:
-                    json.dump(jdict, of, indent=2)
+                jsonData.write()
                 
-       
+
+class MappingThread(th.Thread):
+    def __init__(self, threadID, mapper, lock):
+        th.Thread.__init__(self)
+        self.threadID = threadID
+        self.mapper = mapper
+        self.map_list = mapper.map_list
+        self.lock = lock
+        self.error = None
+
+    def run(self):
+        # Each thread uses its own db connection; datasets are claimed
+        # atomically by do_mapping() through the mapping table status
+        db = database.connection()
+        while self.map_list:
+            self.lock.acquire()
+            if self.map_list:
+                v = self.map_list.pop(0)
+                self.lock.release()
+                try:
+                    self.mapper.do_task(v, db)
+                except Exception as e:
+                    # Stop all workers taking new datasets (as for a serial run); the
+                    # error is raised by Mapping.run() when the workers have finished
+                    self.error = e
+                    with self.lock:
+                        del self.map_list[:]
+                    break
+            else:
+                self.lock.release()
+
 class Mapping(BasicPipeline):
     title = "Bisulphite mapping"
     description = """Maps single end or paired end bisulfite sequence using the GEM3 mapper. 
@@ -259,6 +346,25 @@ class Mapping(BasicPipeline):
   The mapping process can be restricted to a single sample using the option '-n <SAMPLE NAME>' or '-b <SAMPLE BARCODE>'.  The mapping can 
   also be restricted to a single dataset ID using the option '-D <DATASET>'
 
+  If 'map_chunks' is set to N (> 1) in the mapping section of the configuration file then each dataset (apart from those read from
+  a stream or command) is split into N chunks that are mapped as separate tasks, and the chunk BAMs are merged to make the sample
+  BAM.  A single chunk of a dataset can be mapped using the option '--chunk <CHUNK>' together with '-D <DATASET>'.
+
+  If 'map_pool_shards' is set to True in the mapping section of the configuration file then the output of each mapping task is
+  split by contig pool into separate sorted and indexed BAM files (listed in a <DATASET>.shards file).  Calling for a pool can then
+  start as soon as all datasets for the sample have been mapped, reading the shards for the pool from each dataset, without waiting
+  for the sample BAM to be merged.  The shards are not removed after the merge.
+
+  If 'merge_bams' is set to False in the mapping section of the configuration file then no sample BAM is made for samples with
+  more than one dataset (or chunk).  The dataset BAMs are indexed as they are written, and calling reads the reads for each pool
+  directly from them (merging them on the fly), saving the disk space and I/O of the merged BAM.
+
+  Several datasets can be mapped in parallel using the option '--jobs <JOBS>' (or the 'jobs' key in the mapping section of the
+  configuration file).  Each job claims datasets through the database, so the merge for a sample is performed by whichever job
+  finishes the last dataset for that sample.  The merges (and the indexing and md5 sums of the BAMs) are run in the background
+  so the mapping of other datasets does not wait for them.  Up to 'merge_jobs' (default 1) background merges can run at the same
+  time, each using 'merge_threads' threads; these threads are not counted against the cores used for the mapping tasks.
+
   The locations of the input and output data are given by the configuration files; see the gemBS documentation for details.
 
   The --dry-run option will output a list of the mapping / merging operations that would be run by the map command without executing
@@ -272,10 +378,12 @@ class Mapping(BasicPipeline):
     def register(self,parser):
         ## required parameters
         parser.add_argument('-D', '--dataset', dest="fli", metavar="DATASET", help='Dataset to be mapped.', required=False)
+        parser.add_argument('--chunk', dest="chunk", type=int, metavar="CHUNK", help='Only map this chunk of the dataset (if map_chunks is set).', required=False)
         parser.add_argument('-n', '--sample-name', dest="sample_name", metavar="SAMPLE", help='Name of sample to be mapped.', required=False)
         parser.add_argument('-b', '--barcode', dest="sample", metavar="BARCODE", help='Barcode of sample to be mapped.', required=False)
         parser.add_argument('-d', '--tmp-dir', dest="tmp_dir", metavar="PATH", help='Temporary folder to perform sorting operations. Default: /tmp')      
         parser.add_argument('-t', '--threads', dest="threads", help='Number of threads for the mapping pipeline. Default: 1');
+        parser.add_argument('-j', '--jobs', dest="jobs", type=int, help='Number of datasets to map in parallel. Default: 1')
         parser.add_argument('--map-threads', dest="map_threads", help='Number of threads for GEM mapper. Default: threads',default=None)
         parser.add_argument('--sort-threads', dest="sort_threads", help='Number of threads for the sort operations. Default: threads',default=None)
         parser.add_argument('--merge-threads', dest="merge_threads", help='Number of threads for the merge operations. Default: threads',default=None)
@@ -329,27 +437,28 @@ class Mapping(BasicPipeline):
             self.json_commands = {}
         self.command = 'map'
         # JSON data
-        self.jsonData = JSONdata(Mapping.gemBS_json)
+        self.jsonData = self.project_data(Mapping.gemBS_json)
 
         sdata = self.jsonData.sampleData
         if args.fli != None:
             args.sample = sdata[args.fli].sample_barcode
 
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.get_barcode(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
             
         self.name = args.sample
         
         self.tmp_dir = self.jsonData.check(section='mapping',key='tmp_dir',arg=args.tmp_dir,dir_type=True)
         self.threads = self.jsonData.check(section='mapping',key='threads',arg=args.threads,default='1')
+        self.jobs = self.jsonData.check(section='mapping',key='jobs',arg=args.jobs,default=1,int_type=True)
+        if self.dry_run or self.dry_run_json or self.jobs < 1:
+            self.jobs = 1
         self.map_threads = self.jsonData.check(section='mapping',key='map_threads',arg=args.map_threads,default=self.threads)
         self.sort_threads = self.jsonData.check(section='mapping',key='sort_threads',arg=args.sort_threads,default=self.threads)
         self.merge_threads = self.jsonData.check(section='mapping',key='merge_threads',arg=args.merge_threads,default=self.threads)
+        self.merge_jobs = self.jsonData.check(section='mapping',key='merge_jobs',default=1,int_type=True)
         self.sort_memory = self.jsonData.check(section='mapping',key='sort_memory',arg=args.sort_memory, default='768M')
         self.reverse_conv = self.jsonData.check(section='mapping',key='reverse_conversion',arg=args.reverse_conv, boolean=True)
         self.benchmark_mode = self.jsonData.check(section='mapping',key='benchmark_mode',arg=args.benchmark_mode, boolean=True)
@@ -357,11 +466,15 @@ class Mapping(BasicPipeline):
         if self.read_non_stranded:
             self.reverse_conv = False
         self.remove = self.jsonData.check(section='mapping',key='remove_individual_bams',arg=args.remove, boolean=True)
+        self.merge_bams = self.jsonData.check(section='mapping',key='merge_bams',default=True, boolean=True)
         self.underconversion_sequence = self.jsonData.check(section='mapping',key='underconversion_sequence',arg=args.underconversion_sequence)
         self.overconversion_sequence = self.jsonData.check(section='mapping',key='overconversion_sequence',arg=args.overconversion_sequence)
 
         self.input_dir = self.jsonData.check(section='mapping',key='sequence_dir',arg=None,default='.',dir_type=True)
-        self.db = database(self.jsonData)
+        # Input directories are indexed once per run (see input_files())
+        self.input_index = {}
+        self.input_index_lock = th.Lock()
+        self.db = self.project_db()
         self.db.check_index()
         self.mem_db = self.db.mem_db()
 
@@ -374,6 +487,30 @@ class Mapping(BasicPipeline):
         for ix_type in ('index', 'nonbs_index'):
             c.execute("SELECT file, status FROM indexing WHERE type = '{}'".format(ix_type))
             self.index_status[ix_type] = c.fetchone()
+
+        # A mapping task needs memory for the GEM index and the sort buffers
+        index_size = 0
+        for v in self.index_status.values():
+            if v != None and os.path.exists(v[0]):
+                index_size = max(index_size, os.path.getsize(v[0]))
+        self.scheduler = self.resource_scheduler('mapping')
+        # A mapping task keeps its threads for its whole run, so it is not started with less
+        # than half of the requested threads
+        self.scheduler.declare('map', threads=self.map_threads, min_threads=(int(self.map_threads) + 1) // 2,
+                               memory=index_size + int(self.sort_threads) * parse_memory(self.sort_memory))
+        # Merging, indexing and md5 sums of the BAMs are I/O bound, so they are run in the
+        # background by up to merge_jobs workers with their own thread budget, while the
+        # mapping tasks keep the cores busy
+        self.post_lane = None
+        if not (self.dry_run or self.dry_run_json):
+            self.merge_jobs = max(1, self.merge_jobs)
+            self.post_lane = ThreadPoolExecutor(max_workers = self.merge_jobs)
+            self.merge_scheduler = ResourceScheduler(cores = self.merge_jobs * int(self.merge_threads))
+        else:
+            self.merge_scheduler = self.scheduler
+        self.merge_scheduler.declare('bam_merge', threads=self.merge_threads)
+        self.post_tasks = []
+
         for fname, ftype, status in c.execute("SELECT * FROM indexing"):
             if ftype == 'contig_md5':
                 if status != 1:
@@ -405,46 +542,136 @@ class Mapping(BasicPipeline):
                     work_list[smp][0] = fname
             else:
                 work_list[smp][1].append((fl, fname, ftype, status))
+        # Build the list of datasets to be mapped.  A sample is merged by whichever
+        # task finishes the last of its pending datasets (or directly if nothing
+        # remains to be mapped)
+        self.map_list = []
+        self.merge_list = {}
+        self.pending = {}
         for smp, v in work_list.items():
             bamlist = []
             skipped = False
+            tasks = []
             for fl, fname, ftype, status in v[1]:
                 if status == 0:
                     if args.fli != None and args.fli != fl:
                         skipped = True
+                    elif args.chunk != None and (parse_chunk(fname) or (None,))[0] != args.chunk:
+                        skipped = True
                     else:
-                        self.do_mapping(fl)
+                        tasks.append((smp, fl, fname))
                 if ftype != 'SINGLE_BAM':
                     bamlist.append(fname)
-            if not skipped and v[0] != None and not self.no_merge:                    
-                self.do_merge(smp, bamlist, v[0])
+            if not skipped and v[0] != None and not self.no_merge:
+                self.merge_list[smp] = (bamlist, v[0])
+            self.pending[smp] = len(tasks)
+            if tasks:
+                self.map_list.extend(tasks)
+            elif smp in self.merge_list:
+                self.map_list.append((smp, None, None))
+
+        self.lock = th.Lock()
+        if self.jobs > len(self.map_list):
+            self.jobs = len(self.map_list)
+        try:
+            if self.jobs > 1:
+                threads = []
+                for ix in range(self.jobs):
+                    thread = MappingThread(ix, self, self.lock)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+                for thread in threads:
+                    if thread.error != None:
+                        raise thread.error
+            else:
+                while self.map_list:
+                    self.do_task(self.map_list.pop(0), self.db)
+        finally:
+            if self.post_lane != None:
+                self.post_lane.shutdown(wait = True)
+        # Report any failure from the background merges
+        for task in self.post_tasks:
+            task.result()
                     
         if self.dry_run_json and self.json_commands:
             with open(self.dry_run_json, 'w') as of:
                 json.dump(self.json_commands, of, indent = 2)
             
-    def do_mapping(self, fli):
-        # Check if FLI still has status 0 (i.e. has not been claimed by another process)
-        self.db.isolation_level = None
-        c = self.db.cursor()
+    def do_task(self, task, db):
+        smp, fli, fname = task
+        if fli != None:
+            self.do_mapping(fli, db, fname)
+            self.lock.acquire()
+            self.pending[smp] -= 1
+            last = self.pending[smp] == 0
+            self.lock.release()
+            if not last:
+                return
+        if smp in self.merge_list:
+            bamlist, fname = self.merge_list[smp]
+            self.post_merge(smp, list(bamlist), fname, db)
+
+    def post_merge(self, sample, inputs, fname, db):
+        # Hand the merge (or the index and md5 sum for a single BAM) to the background lane
+        if self.post_lane == None:
+            self.do_merge(sample, inputs, fname, db)
+        else:
+            self.post_tasks.append(self.post_lane.submit(self.post_task, sample, inputs, fname))
+
+    def post_task(self, sample, inputs, fname):
+        # Each background worker uses its own db connection
+        self.do_merge(sample, inputs, fname, database.connection())
+
+    def input_files(self, input_dir):
+        # Index of the data files in input_dir, built on first use and shared by all datasets
+        with self.input_index_lock:
+            index = self.input_index.get(input_dir)
+            if index == None:
+                ids = []
+                for fli, v in self.jsonData.sampleData.items():
+                    ids.extend((fli, v.alt_fli))
+                index = InputFileIndex(input_dir, ids)
+                self.input_index[input_dir] = index
+        return index
+        
+    def do_mapping(self, fli, db = None, fname = None):
+        # Check if FLI (or the chunk of FLI in fname) still has status 0 (i.e. has not been claimed by another process)
+        if db == None:
+            db = self.db
+        db.isolation_level = None
+        c = db.cursor()
 
-        try_get_exclusive(c)
+        begin_immediate(c)
+        if fname != None:
+            key = ("filepath", fname)
+        else:
+            key = ("fileid", fli)
         if self.ignore_db:
-            c.execute("SELECT * FROM mapping WHERE fileid = ?", (fli,))
+            c.execute("SELECT * FROM mapping WHERE {} = ?".format(key[0]), (key[1],))
         else:
-            c.execute("SELECT * FROM mapping WHERE fileid = ? AND status = 0", (fli,))
+            c.execute("SELECT * FROM mapping WHERE {} = ? AND status = 0".format(key[0]), (key[1],))
         ret = c.fetchone()
+        # Claim FLI by setting status to 3
+        if ret and not database.backend.claim(c, 'mapping', ret[0]):
+            ret = None
         if ret:
-            # Claim FLI by setting status to 3
             outfile, fl, smp, filetype, status = ret
-            c.execute("UPDATE mapping SET status = 3 WHERE filepath = ?", (outfile,))
-            c.execute("COMMIT")
-            self.name = smp
+            # Chunks of a dataset are named after the chunk BAM
+            chunk = parse_chunk(outfile) if filetype == 'CHUNK_BAM' else None
+            name = os.path.splitext(os.path.basename(outfile))[0] if chunk else fl
+            # Pool shards are written for the contig pools as they are when the task starts
+            shards = pool_shards(outfile, self.jsonData.contigs) if outfile.endswith('.shards') else None
             # Register output files and db cleanup in case of failure
             odir = os.path.dirname(outfile)
-            jfile = os.path.join(odir, fl + '.json')
+            jfile = os.path.join(odir, name + '.json')
             ixfile = os.path.join(odir, smp + '.bai')
-            database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, jfile, ixfile])                
+            outputs = [outfile, jfile, ixfile]
+            if shards != None:
+                outputs.extend(shard_files(shards))
+            database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), outputs, ('mapping', 3), c)
+            c.execute("COMMIT")
 
             try:
                 fliInfo = self.jsonData.sampleData[fli] 
@@ -458,20 +685,20 @@ class Mapping(BasicPipeline):
             ix_type = 'index' if bis else 'nonbs_index'
             v = self.index_status[ix_type]
             if v != None:
-                self.index = v[0]
+                index = v[0]
                 if v[1] != 1:
-                    raise CommandException("GEM Index {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(self.index))
+                    raise CommandException("GEM Index {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(index))
             else:
-                raise CommandException("GEM {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(six_type))
+                raise CommandException("GEM {} not found.  Run 'gemBS index' or correct configuration file and rerun".format(ix_type))
                 
             input_dir = self.input_dir.replace('@BARCODE',bc).replace('@SAMPLE',sample)
 
             #Paired
-            self.paired = self.paired_end
+            paired = self.paired_end
             ftype = self.ftype
-            if not self.paired:
+            if not paired:
                 if ftype == None: ftype = fliInfo.type 
-                if ftype in self.paired_types: self.paired = True
+                if ftype in self.paired_types: paired = True
 
             inputFiles = []
         
@@ -501,7 +728,7 @@ class Mapping(BasicPipeline):
                                 elif 'sam' in v:
                                     ftype = 'SAM'
                                 else:
-                                    ftype = 'INTERLEAVED' if self.paired else 'SINGLE'
+                                    ftype = 'INTERLEAVED' if paired else 'SINGLE'
                             if ftype in self.command_types:
                                 inputFiles.append(v)
                             else:
@@ -514,54 +741,58 @@ class Mapping(BasicPipeline):
                         raise ValueError("Input directory {} does not exist".format(input_dir))
 
                     # Look for likely data files in input_dir
+                    input_index = self.input_files(input_dir)
                     for fli in (fliInfo.getFli(),fliInfo.alt_fli):
                         if fli == None:
                             continue
-                        reg = re.compile("(.*){}(.*?)([12])?[.](fastq|fq|fasta|fa|bam|sam)([.][^.]+)?$".format(fli, re.I))
                         mlist = []
-                        for file in os.listdir(input_dir):
-                            m = reg.match(file)
-                            if m: 
-                                if m.group(5) in [None, '.gz', '.xz', 'bz2', 'z']:
-                                    if ftype == 'PAIRED' and (m.group(3) not in ['1', '2'] or m.group(4).lower() not in ['fasta', 'fa', 'fastq', 'fq']): continue
-                                    if ftype in ['SAM', 'BAM'] and m.group(4).lower() not in ['sam', 'bam']: continue
-                                    mlist.append((file, m))
+                        for m in input_index.get(fli):
+                            if ftype == 'PAIRED' and (m[3] not in ['1', '2'] or m[4].lower() not in ['fasta', 'fa', 'fastq', 'fq']): continue
+                            if ftype in ['SAM', 'BAM'] and m[4].lower() not in ['sam', 'bam']: continue
+                            mlist.append(m)
                             
                         if len(mlist) == 1:
-                            (file, m) = mlist[0]
+                            m = mlist[0]
                             skip = False
                             if ftype is None:
-                                if m.group(4).lower() in ['SAM', 'BAM']:
-                                    ftype = 'BAM' if m.group(4).lower == 'BAM' else 'SAM'
+                                if m[4].lower() in ['SAM', 'BAM']:
+                                    ftype = 'BAM' if m[4].lower == 'BAM' else 'SAM'
                                 else:
-                                    ftype = 'INTERLEAVED' if self.paired else 'SINGLE'
-                            elif ftype == 'PAIRED' or (ftype == 'SAM' and m.group(4).lower != 'sam') or (ftype == 'BAM' and m.group(4).lower() != 'bam'): skip = True
-                            if not skip: inputFiles.append(os.path.join(input_dir,file))
+                                    ftype = 'INTERLEAVED' if paired else 'SINGLE'
+                            elif ftype == 'PAIRED' or (ftype == 'SAM' and m[4].lower != 'sam') or (ftype == 'BAM' and m[4].lower() != 'bam'): skip = True
+                            if not skip: inputFiles.append(os.path.join(input_dir,m[0]))
                         elif len(mlist) == 2:
-                            (file1, m1) = mlist[0]
-                            (file2, m2) = mlist[1]
+                            m1, m2 = mlist
                             for ix in [1, 2, 4]:
-                                if m1.group(ix) != m2.group(ix): break
+                                if m1[ix] != m2[ix]: break
                             else:
-                                if (ftype == None or ftype == 'PAIRED') and m1.group(4) in ['fastq', 'fq', 'fasta', 'fa']:
-                                    if m1.group(3) == '1' and m2.group(3) == '2':
-                                        inputFiles = [os.path.join(input_dir,file1), os.path.join(input_dir,file2)]
-                                    elif m1.group(3) == '2' and m2.group(3) == '1':
-                                        inputFiles = [os.path.join(input_dir,file2), os.path.join(input_dir,file1)]
-                                    self.ftype = 'PAIRED'
-                                    self.paired = True
+                                if (ftype == None or ftype == 'PAIRED') and m1[4] in ['fastq', 'fq', 'fasta', 'fa']:
+                                    if m1[3] == '1' and m2[3] == '2':
+                                        inputFiles = [os.path.join(input_dir,m1[0]), os.path.join(input_dir,m2[0])]
+                                    elif m1[3] == '2' and m2[3] == '1':
+                                        inputFiles = [os.path.join(input_dir,m2[0]), os.path.join(input_dir,m1[0])]
+                                    ftype = 'PAIRED'
+                                    paired = True
                         if inputFiles:
                             break
                 if not inputFiles:
                     raise ValueError('Could not find input files for {} in {}'.format(fliInfo.getFli(),input_dir))
+            if chunk and (ftype in self.stream_types or ftype in self.command_types or
+                          any(f.endswith('|') for f in inputFiles)):
+                raise CommandException("Dataset {} is read from a stream or command and can not be mapped in chunks".format(fli))
 
-            self.curr_fli = fli
-            self.curr_ftype = ftype
-            self.inputFiles = inputFiles
-            self.curr_output_dir = os.path.dirname(outfile)
             if not (self.dry_run or self.dry_run_json):
+                self.lock.acquire()
+                self.name = smp
+                self.index = index
+                self.paired = paired
+                self.curr_fli = fli
+                self.curr_ftype = ftype
+                self.inputFiles = inputFiles
+                self.curr_output_dir = os.path.dirname(outfile)
                 self.log_parameter()
                 logging.gemBS.gt("Bisulfite Mapping...")
+                self.lock.release()
             if self.dry_run or self.dry_run_json:
                 args = self.args
                 com = ['gemBS']
@@ -572,6 +803,7 @@ class Mapping(BasicPipeline):
                     if Mapping.gemBS_json != '.gemBS/gemBS.json':
                         com.extend(['-j',Mapping.gemBS_json])
                 com.extend(['map','--no-merge','-D',fli])
+                if chunk: com.extend(['--chunk',str(chunk[0])])
                 
                 if args.ftype: com.extend(['-T',args.ftype])
                 if args.paired_end: com.append('-p')
@@ -594,63 +826,74 @@ class Mapping(BasicPipeline):
                     task = {}
                     task['command'] = com
                     task['dataset'] = fli
-                    task['sample_barcode'] = self.name
+                    if chunk: task['chunk'] = chunk[0]
+                    task['sample_barcode'] = smp
                     task['inputs'] = inputFiles
-                    task['index'] = self.index
+                    task['index'] = index
                     odir = os.path.dirname(outfile)
-                    report_file = os.path.join(odir,fli + '.json')
-                    logfile = os.path.join(odir,'gem_mapper_' + fli + '.err')
+                    report_file = os.path.join(odir,name + '.json')
+                    logfile = os.path.join(odir,'gem_mapper_' + name + '.err')
                     task['outputs'] = [outfile, report_file, logfile]
-                    desc = "map {}".format(fli)
+                    if shards != None:
+                        task['outputs'].extend(shard_files(shards))
+                    desc = "map {}".format(name)
                     self.json_commands[desc] = task
             else:
                 tmp = self.tmp_dir
                 if not tmp:
                     tmp = os.path.dirname(outfile)
                     
-                ret = mapping(name=fli,index=self.index,fliInfo=fliInfo,inputFiles=inputFiles,ftype=ftype,filetype=filetype,
-                              read_non_stranded=self.read_non_stranded, reverse_conv=self.reverse_conv,
-                              outfile=outfile,paired=self.paired,tmpDir=tmp,
-                              map_threads=self.map_threads,sort_threads=self.sort_threads,sort_memory=self.sort_memory,
-                              under_conversion=self.underconversion_sequence,over_conversion=self.overconversion_sequence,
-                              benchmark_mode=self.benchmark_mode, contig_md5=self.contig_md5, greference=self.fasta_reference) 
+                grant = self.scheduler.acquire('map')
+                try:
+                    ret = mapping(name=name,index=index,fliInfo=fliInfo,inputFiles=inputFiles,ftype=ftype,filetype=filetype,
+                                  read_non_stranded=self.read_non_stranded, reverse_conv=self.reverse_conv,
+                                  outfile=outfile,paired=paired,tmpDir=tmp,
+                                  map_threads=str(grant.threads),sort_threads=str(min(grant.threads, int(self.sort_threads))),sort_memory=self.sort_memory,
+                                  under_conversion=self.underconversion_sequence,over_conversion=self.overconversion_sequence,
+                                  benchmark_mode=self.benchmark_mode, contig_md5=self.contig_md5, greference=self.fasta_reference,
+                                  chunk=chunk, shards=shards, write_index=not self.merge_bams) 
+                finally:
+                    self.scheduler.release(grant)
         
                 if ret:
                     logging.gemBS.gt("Bisulfite Mapping done. Output File: %s" %(ret))
                     
             if filetype == 'SINGLE_BAM':
-                self.do_merge(smp, [], outfile)
-            c = self.db.cursor()
-            c.execute("BEGIN IMMEDIATE")
-            c.execute("UPDATE mapping SET status = 1 WHERE filepath = ?", (outfile,))
+                self.post_merge(smp, [], outfile, db)
+            c = db.cursor()
+            begin_immediate(c)
+            database.backend.finish(c, 'mapping', outfile, 1)
             database.del_db_com(outfile)
             
         c.execute("COMMIT")
-        self.db.isolation_level = 'DEFERRED'
+        db.isolation_level = 'DEFERRED'
     
-    def do_merge(self, sample, inputs, fname):
+    def do_merge(self, sample, inputs, fname, db = None):
+        if db == None:
+            db = self.db
         if inputs:
             inputs.sort()
-            self.db.isolation_level = None
-            c = self.db.cursor()
-            try_get_exclusive(c)
-            res = c.execute("SELECT * FROM mapping WHERE sample = ?", (sample,))
+            db.isolation_level = None
+            c = db.cursor()
+            begin_immediate(c)
+            res = database.backend.rows(c, 'mapping', sample)
             if res:
                 mstat = 1
+                combine = False
                 for filename, fl, smp, ftype, status in res:
-                    if ftype == 'MULTI_BAM' and status != 1: break
+                    if ftype == 'CHUNK_BAM' or filename.endswith('.shards'): combine = True
+                    if ftype in ('MULTI_BAM', 'CHUNK_BAM') and status != 1: break
                     if ftype == 'MRG_BAM':
                         outfile = filename
                         mstat = status
                 else:
-                    if mstat == 0:
-                        c.execute("UPDATE mapping SET status = 3 WHERE filepath = ?", (outfile,))
-                        c.execute("COMMIT")
+                    if mstat == 0 and database.backend.claim(c, 'mapping', outfile):
                         # Register output files and db cleanup in case of failure
                         odir = os.path.dirname(outfile)
                         ixfile = os.path.join(odir, smp + '.csi')
                         md5file = outfile + '.md5'
-                        database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, ixfile, md5file])
+                        database.reg_db_com(outfile, "UPDATE mapping SET status = 0 WHERE filepath = '{}'".format(outfile), [outfile, ixfile, md5file], ('mapping', 3), c)
+                        c.execute("COMMIT")
                         if self.dry_run or self.dry_run_json:
                             args = self.args
                             com = ['gemBS']
@@ -676,21 +919,27 @@ class Mapping(BasicPipeline):
                                 desc = "merge {}".format(smp)
                                 self.json_commands[desc] = task
                         else:
-                            ret = merging(inputs = inputs, sample = sample, threads = self.merge_threads, outname = outfile,
-                                          benchmark_mode=self.benchmark_mode, greference=self.fasta_reference)
+                            grant = self.merge_scheduler.acquire('bam_merge')
+                            try:
+                                ret = merging(inputs = inputs, sample = sample, threads = str(grant.threads), outname = outfile,
+                                              benchmark_mode=self.benchmark_mode, greference=self.fasta_reference, combine=combine)
+                            finally:
+                                self.merge_scheduler.release(grant)
                             if ret:
                                 logging.gemBS.gt("Merging process done for {}. Output files generated: {}".format(sample, ','.join(ret)))
                                 
-                        try_get_exclusive(c)
+                        begin_immediate(c)
                         if self.remove:
                             for f in inputs:
+                                # Pool shards are kept as calling tasks may still be reading them
+                                if f.endswith('.shards'): continue
                                 if not self.dry_run or self.dry_run_json:
                                     if os.path.exists(f): os.remove(f)
-                                c.execute("UPDATE mapping SET status = 2 WHERE filepath = ?", (f,))
-                        c.execute("UPDATE mapping SET status = 1 WHERE filepath = ?", (outfile,))
+                                database.backend.finish(c, 'mapping', f, 2)
+                        database.backend.finish(c, 'mapping', outfile, 1)
                         database.del_db_com(outfile)
             c.execute("COMMIT")
-            self.db.isolation_level = 'DEFERRED'
+            db.isolation_level = 'DEFERRED'
         else:
             # No merging required - just create index
             if self.dry_run or self.dry_run_json:
@@ -779,9 +1028,12 @@ class Merging(Mapping):
         self.command = 'merge-bams'
         
         # JSON data
-        self.jsonData = JSONdata(Mapping.gemBS_json)
+        self.jsonData = self.project_data(Mapping.gemBS_json)
         self.threads = self.jsonData.check(section='mapping',key='threads',arg=args.threads,default='1')
         self.merge_threads = self.jsonData.check(section='mapping',key='merge_threads',arg=args.threads,default=self.threads)
+        self.scheduler = self.resource_scheduler('mapping')
+        self.scheduler.declare('bam_merge', threads=self.merge_threads)
+        self.merge_scheduler = self.scheduler
         self.remove = self.jsonData.check(section='mapping',key='remove_individual_bams',arg=args.remove, boolean=True)
         self.benchmark_mode = self.jsonData.check(section='mapping',key='benchmark_mode',arg=args.benchmark_mode, boolean=True)
         self.dry_run = args.dry_run
@@ -795,18 +1047,14 @@ class Merging(Mapping):
         if self.dry_run_json:
             self.json_commands = {}
         
-        sdata = self.jsonData.sampleData
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.get_barcode(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
                 
         # Create Dictionary of samples and bam files, checking everything required has already been made
         
-        self.db = database(self.jsonData)
+        self.db = self.project_db()
         self.db.check_index()
         self.mem_db = self.db.mem_db()
 
@@ -836,7 +1084,7 @@ class Merging(Mapping):
                     work_list[smp][0] = fname
                 else:
                     work_list[smp][3] = True
-            elif ftype == 'MULTI_BAM':
+            elif ftype in ('MULTI_BAM', 'CHUNK_BAM'):
                 if status == 1:
                     work_list[smp][1].append(fname)
                 else:
@@ -929,7 +1177,7 @@ class MethylationCall(BasicPipeline):
         self.command = 'call'
 
         # JSON data
-        self.jsonData = JSONdata(MethylationCall.gemBS_json)
+        self.jsonData = self.project_data(MethylationCall.gemBS_json)
 
         if args.list_pools > 0:
             ctgs = self.jsonData.contigs
@@ -941,8 +1189,9 @@ class MethylationCall(BasicPipeline):
             return
                     
         self.threads = self.jsonData.check(section='calling',key='threads',arg=args.threads,default='1')
-        self.call_threads = self.jsonData.check(section='calling',key='call_threads',arg=args.threads,default=self.threads)
-        self.merge_threads = self.jsonData.check(section='calling',key='merge_threads',arg=args.threads,default=self.threads)
+        self.call_threads = self.jsonData.check(section='calling',key='call_threads',arg=args.call_threads,default=self.threads)
+        self.call_memory = self.jsonData.check(section='calling',key='call_memory',arg=None)
+        self.merge_threads = self.jsonData.check(section='calling',key='merge_threads',arg=args.merge_threads,default=self.threads)
         self.jobs = self.jsonData.check(section='calling',key='jobs',arg=args.jobs,default=1,int_type=True)
         self.mapq_threshold = self.jsonData.check(section='calling',key='mapq_threshold',arg=args.mapq_threshold)
         self.qual_threshold = self.jsonData.check(section='calling',key='qual_threshold',arg=args.qual_threshold)
@@ -960,6 +1209,7 @@ class MethylationCall(BasicPipeline):
         if isinstance(self.conversion, list):
             self.conversion = ','.join(self.conversion)
         self.remove = self.jsonData.check(section='calling',key='remove_individual_bcfs',arg=args.remove, boolean=True)
+        self.pool_balance = self.jsonData.check(section='calling',key='pool_balance',arg=None,default='length')
 
         self.dry_run = args.dry_run
         self.args = args
@@ -976,13 +1226,9 @@ class MethylationCall(BasicPipeline):
             self.json_commands = {}
         else:
             self.json_commands = None
-        sdata = self.jsonData.sampleData
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.get_barcode(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
 
         if self.contig_list != None:
@@ -997,10 +1243,16 @@ class MethylationCall(BasicPipeline):
                         self.contig_list = tmp_list
                         self.jsonData.config['calling']['contig_list'] = tmp_list
                         
-        self.db = database(self.jsonData)
+        self.db = self.project_db()
         self.mem_db = self.db.mem_db()
         if not self.mem_db:
             self.db.check_index()
+            # With the in memory db the pools are planned by length when the db is created.  Under
+            # gemBS run the pools are planned once before the tasks are started
+            if self.pool_balance == 'coverage' and not (args.concat or self.dry_run or self.dry_run_json or BasicPipeline.node_json != None):
+                self.plan_pools()
+        elif self.pool_balance == 'coverage':
+            logging.warning("pool_balance = coverage needs a disk db (gembs_dbfile) - balancing pools by length")
             
         # If we are doing a dry-run we will use an in memory copy of the db so the on disk db is not touched
         if self.dry_run or self.dry_run_json:
@@ -1011,6 +1263,7 @@ class MethylationCall(BasicPipeline):
         self.sample_conversion = {}
         
         if self.conversion != None and self.conversion.lower() == "auto" and not args.concat:
+            from .reportStats import LaneStats,SampleStats
             sample_lane_files = {}
             if args.sample:
                 ret = c.execute("SELECT filepath, fileid, sample FROM mapping WHERE sample = ? AND type != 'MRG_BAM'", (args.sample,))
@@ -1072,17 +1325,36 @@ class MethylationCall(BasicPipeline):
         #Check input bam existance
         
         sampleBam = {}
+        not_ready = {}
+        # Dataset BAMs (or pool shards) for each sample, or None if not all are available
+        sampleLanes = {}
         if args.sample:
-            ret = c.execute("SELECT * from mapping WHERE (sample = ?) AND (type != 'MULTI_BAM')", (args.sample,))
+            ret = c.execute("SELECT * from mapping WHERE sample = ?", (args.sample,))
         else:            
-            ret = c.execute("SELECT * from mapping WHERE type != 'MULTI_BAM'")
-        for fname, fli, smp, ftype, status in ret:
-            if status == 1 or self.ignore_db or self.ignore_dep:
+            ret = c.execute("SELECT * from mapping")
+        for fname, fli, smp, ftype, status in ret.fetchall():
+            if ftype in ('MULTI_BAM', 'CHUNK_BAM'):
+                if smp in sampleLanes and sampleLanes[smp] == None:
+                    continue
+                if status == 1 or self.ignore_db or self.ignore_dep:
+                    sampleLanes.setdefault(smp, []).append(fname)
+                else:
+                    sampleLanes[smp] = None
+                    not_ready.setdefault(smp, fname)
+            elif status == 1 or self.ignore_db or self.ignore_dep:
                 if not os.path.isfile(fname):
                     if not (self.ignore_db or self.ignore_dep):
                         raise CommandException("Sorry file '{}' was not found".format(fname))
                 sampleBam[smp] = fname
             else:
+                not_ready[smp] = fname
+        # Calling reads directly from the dataset BAMs if no sample BAM is made, and from the
+        # pool shards if the sample BAM has not been merged yet
+        for smp, lanes in sampleLanes.items():
+            if lanes and not smp in sampleBam and (not smp in not_ready or all(f.endswith('.shards') for f in lanes)):
+                sampleBam[smp] = sorted(lanes)
+        for smp, fname in not_ready.items():
+            if not smp in sampleBam:
                 logging.gemBS.gt("Sample BAM file '{}' not ready".format(fname))
 
         if not sampleBam:
@@ -1095,12 +1367,15 @@ class MethylationCall(BasicPipeline):
             tmp_list = []
             ctg_pool = {}
             for pl, v in contigs.items():
-                for ctg in v:
-                    ctg_pool[ctg] = pl
+                for reg in v:
+                    ctg = parse_region(reg)[0]
+                    if not ctg in ctg_pool:
+                        ctg_pool[ctg] = []
+                    ctg_pool[ctg].append(pl)
             for ctg in self.contig_list:
-                pl = ctg_pool[ctg]
-                if not pl in tmp_list:
-                    tmp_list.append(pl)
+                for pl in ctg_pool[ctg]:
+                    if not pl in tmp_list:
+                        tmp_list.append(pl)
             self.contig_list = tmp_list
         else:
             self.contig_list = list(contigs.keys())
@@ -1110,7 +1385,16 @@ class MethylationCall(BasicPipeline):
                 self.contig_list = [args.req_pool]
             else:
                 self.contig_list = []
-            
+
+        # Dataset BAMs are merged on the fly for each pool, and without a region file for samtools merge
+        # a pool of several contigs would have to read through the whole of each BAM
+        if not (self.dry_run or self.dry_run_json) and any(len(contigs[pl]) > 1 for pl in self.contig_list):
+            for smp, bams in sampleBam.items():
+                if isinstance(bams, list) and len(bams) > 1 and not all(f.endswith('.shards') for f in bams):
+                    if not executables.supports('samtools', 'merge', '-L'):
+                        raise CommandException("Calling sample {} from the dataset BAMs (merge_bams = False) needs a samtools merge that supports -L".format(smp))
+                    break
+
         # Get output files
         ind_bcf = {}
         mrg_bcf = {}
@@ -1141,7 +1425,9 @@ class MethylationCall(BasicPipeline):
                 if call:
                     self.sampleBam[smp] = fname
                 
-        self.input = list(self.sampleBam.values())
+        self.input = []
+        for v in self.sampleBam.values():
+            self.input.extend(v if isinstance(v, list) else [v])
         self.samples = list(sampleBam.keys())
         self.output = []
         for smp, pl in self.outputBcf.items():
@@ -1205,7 +1491,7 @@ class MethylationCall(BasicPipeline):
                                      dbSNP_index_file=self.dbSNP_index_file,call_threads=self.call_threads,merge_threads=self.merge_threads,jobs=self.jobs,
                                      mapq_threshold=self.mapq_threshold,bq_threshold=self.qual_threshold,dry_run_json=self.dry_run_json,
                                      haploid=self.haploid,conversion=self.conversion,ref_bias=self.ref_bias,sample_conversion=self.sample_conversion,
-                                     benchmark_mode=self.benchmark_mode)
+                                     benchmark_mode=self.benchmark_mode,scheduler=self.resource_scheduler('calling'),call_memory=self.call_memory)
                 
             if ret and not (self.dry_run or self.dry_run_json):
                 if args.concat:
@@ -1232,7 +1518,7 @@ class MethylationCall(BasicPipeline):
         if self.dbSNP_index_file:
             printer("dbSNP File      : %s", self.dbSNP_index_file)
         for sample,input_bam in self.sampleBam.items():
-            printer("Sample: %s    Bam: %s" %(sample,input_bam))
+            printer("Sample: %s    Bam: %s" %(sample,','.join(input_bam) if isinstance(input_bam, list) else input_bam))
         printer("")
 
 class BsCallConcatenate(MethylationCall):
@@ -1372,11 +1658,14 @@ class MethylationFiltering(BasicPipeline):
         self.command = 'extract'
 
         # JSON data
-        self.jsonData = JSONdata(Mapping.gemBS_json)
+        self.jsonData = self.project_data(Mapping.gemBS_json)
 
         self.threads = self.jsonData.check(section='extract',key='threads')
         self.extract_threads = self.jsonData.check(section='extract',key='extract_threads',arg=args.extract_threads,default=self.threads)
         self.jobs = self.jsonData.check(section='extract',key='jobs',arg=args.jobs,default=1,int_type=True)
+        self.extract_memory = self.jsonData.check(section='extract',key='extract_memory',arg=None)
+        self.scheduler = self.resource_scheduler('extract')
+        self.scheduler.declare('extract', threads=self.extract_threads if self.extract_threads else 1, memory=self.extract_memory)
         self.allow_het = self.jsonData.check(section='extract',key='allow_het',arg=args.allow_het,boolean=True,default=False)
         self.cpg = self.jsonData.check(section='extract',key='make_cpg',arg=args.cpg,boolean=True,default=False)
         self.snps = self.jsonData.check(section='extract',key='make_snps',arg=args.snps,boolean=True,default=False)
@@ -1411,24 +1700,15 @@ class MethylationFiltering(BasicPipeline):
         if not (self.cpg or self.non_cpg or self.bedMethyl or self.snps):
             self.cpg = True
 
-        self.mask = 0
-        if self.cpg: self.mask |= 3
-        if self.non_cpg: self.mask |= 12
-        if self.bedMethyl: self.mask |= 48
-#        if self.bigWig: self.mask |= 192
-        if self.snps: self.mask |= 768
+        self.mask = self.output_mask(self.cpg, self.non_cpg, self.bedMethyl, self.snps)
         self.mask1 = self.mask & 341
         
-        sdata = self.jsonData.sampleData
         if not args.sample and args.sample_name:
-            for k, v in sdata.items():
-                if v.sample_name == args.sample_name:
-                    args.sample = v.sample_barcode
-                    break
-            else:
+            args.sample = self.jsonData.get_barcode(args.sample_name)
+            if args.sample == None:
                 raise ValueError("Sample name '{}' not found".format(args.sample_name))
                 
-        db = database(self.jsonData)
+        db = self.project_db()
         self.mem_db = db.mem_db()
         if not self.mem_db:
             db.check_index()        
@@ -1482,6 +1762,9 @@ class MethylationFiltering(BasicPipeline):
                     threads.append(thread)
                 for thread in threads:
                     thread.join()
+                for thread in threads:
+                    if thread.error != None:
+                        raise thread.error
             else:
                 for v in self.bcf_list:
                     self.do_filter(v)
@@ -1490,27 +1773,37 @@ class MethylationFiltering(BasicPipeline):
             with open(self.dry_run_json, 'w') as of:
                 json.dump(self.json_commands, of, indent = 2)
 
+    @staticmethod
+    def output_mask(cpg, non_cpg, bedMethyl, snps):
+        """Bits of the extract table status for the requested outputs.  For each output
+        the lower bit is set when it is done, and both bits while it is being made"""
+        if not (cpg or non_cpg or bedMethyl or snps):
+            cpg = True
+        mask = 0
+        if cpg: mask |= 3
+        if non_cpg: mask |= 12
+        if bedMethyl: mask |= 48
+        if snps: mask |= 768
+        return mask
+
     def do_filter(self, v):
         sample, bcf_file = v
         self.bcf_file = bcf_file
-        db = database()
+        db = database.connection()
         db.isolation_level = None
         c = db.cursor()
 
-        try_get_exclusive(c)
+        begin_immediate(c)
         
-        c.execute("SELECT filepath, status FROM extract WHERE sample = ?", (sample,))
-        ret = c.fetchone()
+        ret = database.backend.rows(c, 'extract', sample)
         if ret:
-            filebase, status = ret
+            filebase, smp, status = ret[0]
             old_stat = status
             sm = status & self.mask
             if self.ignore_db:
                 sm = 0
-            if not (sm == self.mask or sm == self.mask1):
+            if not (sm == self.mask or sm == self.mask1) and database.backend.claim(c, 'extract', filebase, status | self.mask):
                 status1 = status | self.mask
-                c.execute("UPDATE extract SET status = ? WHERE filepath = ?", (status1, filebase))
-                c.execute("COMMIT")
                 files = [filebase + "_contig_list.bed"]
                 cpg, non_cpg, bigWig, bedMethyl, snps = (False, False, False, False, False)
                 if self.cpg and not (sm & 3):
@@ -1534,6 +1827,10 @@ class MethylationFiltering(BasicPipeline):
                     snps = True
                     files.extend([filebase + '_snps.txt.gz', filebase + '_snps.txt.gz_tbi', filebase + '_snps.txt.gz.md5'])
 
+                if not (self.dry_run or self.dry_run_json):
+                    database.reg_db_com(filebase, "UPDATE extract SET status = 0 WHERE filepath = '{}'".format(filebase), files, ('extract', status1), c)
+                c.execute("COMMIT")
+
                 if self.dry_run or self.dry_run_json:
                     args = self.args
                     com = ['gemBS']
@@ -1576,29 +1873,291 @@ class MethylationFiltering(BasicPipeline):
                         task['outputs'] = files[1:]
                         self.json_commands[desc] = task
                 else:
-                    database.reg_db_com(filebase, "UPDATE extract SET status = 0 WHERE filepath = '{}'".format(filebase), files)                
-
                     #Call methylation extract
-                    ret = methylationFiltering(bcfFile=bcf_file,outbase=filebase,name=sample,strand_specific=self.strand_specific,bw_strand_specific=self.bw_strand_specific,
-                                               cpg=cpg,non_cpg=non_cpg,contig_list=self.contig_list,allow_het=self.allow_het,
-                                               inform=self.inform,phred=self.phred,min_nc=self.min_nc,bedMethyl=bedMethyl,
-                                               bigWig=bigWig,contig_size_file=self.contig_size_file,ref_bias=self.ref_bias,
-                                               snps=snps,snp_list=self.snp_list,snp_db=self.snp_db,extract_threads=self.extract_threads)
+                    grant = self.scheduler.acquire('extract')
+                    try:
+                        ret = methylationFiltering(bcfFile=bcf_file,outbase=filebase,name=sample,strand_specific=self.strand_specific,bw_strand_specific=self.bw_strand_specific,
+                                                   cpg=cpg,non_cpg=non_cpg,contig_list=self.contig_list,allow_het=self.allow_het,
+                                                   inform=self.inform,phred=self.phred,min_nc=self.min_nc,bedMethyl=bedMethyl,
+                                                   bigWig=bigWig,contig_size_file=self.contig_size_file,ref_bias=self.ref_bias,snps=snps,snp_list=self.snp_list,
+                                                   snp_db=self.snp_db,extract_threads=str(grant.threads) if self.extract_threads else None)
+                    finally:
+                        self.scheduler.release(grant)
                     if ret:
                         logging.gemBS.gt("Results extraction for {} done, results located in: {}".format(bcf_file, ret))
 
                     status1 = (old_stat | self.mask1) & 341
                     database.del_db_com(filebase)
-                c.execute("BEGIN IMMEDIATE")
-                c.execute("UPDATE extract SET status = ? WHERE filepath = ?", (status1, filebase))
+                begin_immediate(c)
+                database.backend.finish(c, 'extract', filebase, status1)
                
         c.execute("COMMIT")
-        db.close()
+        db.isolation_level = 'DEFERRED'
         
     def extra_log(self):
         """Extra Parameters to be printed"""
         #Virtual methods, to be define in child class
         
+class RunThread(th.Thread):
+    def __init__(self, threadID, runner):
+        th.Thread.__init__(self)
+        self.threadID = threadID
+        self.runner = runner
+
+    def run(self):
+        self.runner.worker()
+
+class Run(BasicPipeline):
+    title = "Run pipeline"
+    description = """Runs the mapping, calling and extraction stages of the pipeline for all samples (or for a single sample).
+
+  Rather than working through all samples for one stage before starting the next stage (as happens when the map, call and
+  extract commands are run one after the other), the run command looks at the state of the mapping, calling and extract
+  tables in the database and starts any task whose inputs are available.  The tasks are:
+
+    map        - map a single dataset
+    merge-bams - merge the BAMs for a sample once all of its datasets have been mapped
+    call       - call a single contig pool for a sample once the sample BAM is available
+    merge-bcfs - merge the BCFs for a sample once all of its contig pools have been called
+    extract    - extract methylation and SNP information for a sample once the sample BCF is available
+
+  Up to <JOBS> tasks are run in parallel (option '--jobs <JOBS>' or the 'jobs' key in the default section of the configuration
+  file), so one sample can be calling while another is still mapping.  When several tasks are ready, tasks from later stages
+  are preferred so that samples are completed as early as possible, and larger contig pools are called first.  Each task is
+  run with the options taken from the configuration file for the corresponding stage, and the threads used by the tasks are 
+  limited by the max_cores and max_memory configuration keys.
+
+  The tasks claim their work through the database in the same way as the individual commands, so several instances of
+  gemBS run (or of the individual commands) can be run at the same time on the same analysis if a disk based database is used.
+
+  If a task fails, no further tasks are started for that sample, but the other samples will be processed.  
+    """
+
+    def register(self,parser):
+        parser.add_argument('-n','--sample-name',dest="sample_name",metavar="SAMPLE",help="Name of sample to be processed")
+        parser.add_argument('-b','--barcode',dest="sample",metavar="BARCODE",help="Barcode of sample to be processed")
+        parser.add_argument('-j','--jobs', dest="jobs", type=int, help='Number of tasks to run in parallel. Default: 1')
+
+    def run(self, args):
+        self.command = 'run'
+
+        # JSON data
+        self.jsonData = JSONdata(Run.gemBS_json)
+        self.jobs = self.jsonData.check(section='DEFAULT',key='jobs',arg=args.jobs,default=1,int_type=True)
+        if self.jobs < 1:
+            self.jobs = 1
+
+        if not args.sample and args.sample_name:
+            args.sample = self.jsonData.get_barcode(args.sample_name)
+            if args.sample == None:
+                raise ValueError("Sample name '{}' not found".format(args.sample_name))
+        self.sample = args.sample
+
+        self.db = database(self.jsonData)
+        self.mem_db = self.db.mem_db()
+        self.db.check_index()
+        # Outputs to be made by the extract stage
+        self.extract_mask = MethylationFiltering.output_mask(
+            self.jsonData.check(section='extract',key='make_cpg',arg=None,boolean=True,default=False),
+            self.jsonData.check(section='extract',key='make_non_cpg',arg=None,boolean=True,default=False),
+            self.jsonData.check(section='extract',key='make_bedmethyl',arg=None,boolean=True,default=False),
+            self.jsonData.check(section='extract',key='make_snps',arg=None,boolean=True,default=False))
+        # The pools must not change while calling tasks are running
+        if not self.mem_db and self.jsonData.check(section='calling',key='pool_balance',arg=None,default='length') == 'coverage':
+            self.plan_pools()
+
+        # All tasks share a single budget of cores and memory, and the project data and db
+        # set up here
+        BasicPipeline.node_scheduler = self.resource_scheduler('DEFAULT')
+        BasicPipeline.node_json = self.jsonData
+        
+        self.dispatched = set()
+        self.failed = {}
+        self.running = 0
+        self.cond = th.Condition()
+        # Ready tasks for each sample, updated from the db when a task for the sample finishes
+        self.ready = {}
+        self.refresh(self.db)
+        self.log_parameter()
+        try:
+            if self.jobs > 1:
+                threads = []
+                for ix in range(self.jobs):
+                    thread = RunThread(ix, self)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            else:
+                self.worker()
+        finally:
+            BasicPipeline.node_scheduler = None
+            BasicPipeline.node_json = None
+        self.db.close()
+
+        if self.failed:
+            raise CommandException("Pipeline failed for sample(s) {}".format(', '.join(sorted(self.failed))))
+        logging.gemBS.gt("Pipeline run finished")
+
+    def worker(self):
+        db = database.connection()
+        self.cond.acquire()
+        while True:
+            task = self.next_task()
+            if task == None and self.running == 0:
+                # Pick up any work made ready by other processes before finishing
+                self.refresh(db)
+                task = self.next_task()
+            if task == None:
+                if self.running == 0:
+                    # Nothing is ready and nothing that could make a task ready is running
+                    self.cond.notify_all()
+                    break
+                self.cond.wait()
+                continue
+            self.dispatched.add(task)
+            self.running += 1
+            self.cond.release()
+            try:
+                self.do_task(task)
+            except Exception as e:
+                logging.error("Task {} failed: {}".format(' '.join(str(x) for x in task if x != None), str(e)))
+                self.cond.acquire()
+                self.failed[task[1]] = task
+                self.cond.release()
+            ready = self.sample_tasks(db, task[1])
+            self.cond.acquire()
+            self.ready.update(ready)
+            self.running -= 1
+            self.cond.notify_all()
+        self.cond.release()
+
+    def refresh(self, db):
+        """Read the ready tasks for all samples from the db"""
+        ready = self.sample_tasks(db)
+        with self.cond:
+            self.ready = ready
+
+    def sample_tasks(self, db, sample = None):
+        """Find the tasks that are ready to run (i.e., that have all of their inputs
+        available) for one sample, or for all samples if sample is None.  Returns a
+        dict with the list of ready tasks for each sample in order of priority"""
+        samples = {}
+        if sample != None:
+            samples[sample] = None
+        db.isolation_level = None
+        c = db.cursor()
+        begin_immediate(c)
+        try:
+            mapping_rows = database.backend.rows(c, 'mapping', sample)
+            calling_rows = database.backend.rows(c, 'calling', sample)
+            extract_rows = database.backend.rows(c, 'extract', sample)
+        finally:
+            c.execute("COMMIT")
+            db.isolation_level = 'DEFERRED'
+        for fname, fl, smp, ftype, status in mapping_rows:
+            if samples.get(smp) == None:
+                samples[smp] = {'datasets': [], 'bam': None, 'bams_done': True, 'shards': True, 'pools': [], 'bcf': None, 'bcfs_done': True, 'extract': None}
+            v = samples[smp]
+            if ftype == 'MRG_BAM':
+                v['bam'] = status
+            else:
+                if not fname.endswith('.shards'):
+                    v['shards'] = False
+                if ftype == 'SINGLE_BAM':
+                    v['bam'] = status
+                elif status != 1:
+                    v['bams_done'] = False
+                if status == 0:
+                    v['datasets'].append((fl, parse_chunk(fname) if ftype == 'CHUNK_BAM' else None))
+        for fname, pool, smp, psize, ftype, status in calling_rows:
+            v = samples.get(smp)
+            if v == None:
+                continue
+            if ftype == 'MRG_BCF':
+                v['bcf'] = status
+            else:
+                if status != 1:
+                    v['bcfs_done'] = False
+                if status == 0:
+                    v['pools'].append((pool, psize))
+        for fname, smp, status in extract_rows:
+            v = samples.get(smp)
+            if v != None:
+                v['extract'] = status
+
+        tasks = {}
+        for smp, v in samples.items():
+            ready = []
+            if v == None or (self.sample and smp != self.sample):
+                tasks[smp] = ready
+                continue
+            # Extraction is needed unless the requested outputs are done or being made
+            # (in the same way as is checked by the extract command)
+            mask = self.extract_mask
+            if v['bcf'] == 1 and v['extract'] != None and not (v['extract'] & mask) in (mask, mask & 341):
+                ready.append((0, 0, ('extract', smp)))
+            elif v['bcf'] == 0 and v['bcfs_done']:
+                ready.append((1, 0, ('merge-bcfs', smp)))
+            # Calling can start from the dataset BAMs if no sample BAM is made, or from
+            # pool shards without waiting for the merge
+            if v['bam'] == 1 or (v['bams_done'] and (v['shards'] or v['bam'] == None)):
+                for pool, psize in v['pools']:
+                    ready.append((2, -psize, ('call', smp, pool)))
+            if v['bam'] == 0 and v['bams_done'] and not v['datasets']:
+                ready.append((3, 0, ('merge-bams', smp)))
+            for fl, chunk in v['datasets']:
+                ready.append((4, 0, ('map', smp, fl, chunk[0] if chunk else None)))
+            ready.sort(key = lambda x: (x[0], x[1]))
+            tasks[smp] = ready
+        return tasks
+        
+    def next_task(self):
+        """Find the highest priority ready task that has not already been started by
+        this process (called with self.cond held)"""
+        best = None
+        for smp, ready in self.ready.items():
+            if smp in self.failed:
+                continue
+            # Tasks already started are dropped from the front of the list
+            while ready and ready[0][2] in self.dispatched:
+                ready.pop(0)
+            if ready and (best == None or ready[0][:2] < best[:2]):
+                best = ready[0]
+        return best[2] if best != None else None
+
+    def do_task(self, task):
+        """Run a single task using the command for the corresponding stage, with
+        options taken from the configuration file"""
+        stage, smp = task[0], task[1]
+        if stage == 'map':
+            opts = ['-b', smp, '-D', task[2], '--no-merge', '-j', '1']
+            if task[3] != None:
+                opts.extend(['--chunk', str(task[3])])
+            self.run_stage(Mapping(), opts)
+        elif stage == 'merge-bams':
+            self.run_stage(Merging(), ['-b', smp])
+        elif stage == 'call':
+            self.run_stage(MethylationCall(), ['-b', smp, '--pool', task[2], '--no-merge', '-j', '1'])
+        elif stage == 'merge-bcfs':
+            self.run_stage(BsCallConcatenate(), ['-b', smp, '-j', '1'])
+        else:
+            self.run_stage(MethylationFiltering(), ['-b', smp, '-j', '1'])
+
+    def run_stage(self, stage, opts):
+        parser = argparse.ArgumentParser()
+        stage.register(parser)
+        stage.run(parser.parse_args(opts))
+
+    def extra_log(self):
+        """Extra Parameters to be printed"""
+        printer = logging.gemBS.gt
+
+        printer("------------ Pipeline Run ------------")
+        printer("Sample          : %s", self.sample if self.sample else 'All')
+        printer("Parallel tasks  : %s", self.jobs)
+        printer("")
+
 class MappingReports(BasicPipeline):
     title = "Bisulfite Mapping reports"
     description = """Bisulfite mapping report generation.  Builds a HTML and SPHINX report per dataset and sample """
@@ -1626,8 +2185,11 @@ class MappingReports(BasicPipeline):
         sample_files = {}   
         c = db.cursor()
         sample_missing = {}
-        for fname, fli, smp, status in c.execute("SELECT filepath, fileid, sample, status FROM MAPPING WHERE type != 'MRG_BAM'"):
+        for fname, fli, smp, ftype, status in c.execute("SELECT filepath, fileid, sample, type, status FROM MAPPING WHERE type != 'MRG_BAM'"):
             ok = False
+            # Each chunk of a dataset has its own report
+            if ftype == 'CHUNK_BAM':
+                fli = os.path.splitext(os.path.basename(fname))[0]
             fileJson = os.path.join(os.path.dirname(fname), "{}.json".format(fli))
             if status != 0:
                 if os.path.isfile(fileJson):
@@ -1651,6 +2213,8 @@ class MappingReports(BasicPipeline):
         if len(sample_files) < 1:
             raise CommandException("Sorry no JSON files were found")
 
+        from .report import buildReport as htmlBuildReport
+        from .sphinx import buildReport as sphinxBuildReport
         self.log_parameter()
         logging.gemBS.gt("Building html reports...")
         htmlBuildReport(inputs=sample_files,output_dir=self.output_dir,name=self.project)
@@ -1699,6 +2263,9 @@ class VariantsReports(BasicPipeline):
             fileJson = os.path.splitext(fname)[0] + '.json'
             ok = False
             if status != 0:
+                if os.path.isfile(fname) and os.path.getsize(fname) == 0:
+                    # Stub BCF for a pool with no reads - there is no report for this pool
+                    continue
                 if os.path.isfile(fileJson):
                     ok = True
                     if not smp in sample_files:
@@ -1716,6 +2283,7 @@ class VariantsReports(BasicPipeline):
             for smp, v in sample_missing.items():
                 logging.gemBS.gt("{}: {}".format(smp, v))                        
 
+        from .bsCallReports import buildBscallReports
         self.log_parameter()
         logging.gemBS.gt("Building variant calls html and sphinx reports...")
         buildBscallReports(inputs=sample_files,output_dir=self.output_dir,name=self.project,threads=int(self.threads))
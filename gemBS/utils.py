@@ -8,6 +8,7 @@ the command environment.
 """
 
 import os
+import re
 
 import subprocess
 import logging
@@ -15,7 +16,13 @@ import json
 import signal
 import tempfile
 import time
+import gzip
+import struct
+import threading as th
+import hashlib
+import shutil
 from io import IOBase
+from concurrent.futures import ThreadPoolExecutor
 
 class CommandException(Exception):
     """Exception thrown by gemtools commands"""
@@ -337,6 +344,113 @@ def run_tool(tool, **kwargs):
     """
     return run_tools([tool], **kwargs)
 
+class MD5Writer:
+    """Computes the md5 sum of an output file while it is written, so that the file
+    does not have to be read again by md5sum.
+
+    The tool writing the file is given the path of a named pipe (self.path) in a
+    temporary directory instead of the output file.  A thread copies the data from
+    the pipe to the output file, updating the md5 sum, and the md5 file is written
+    (in md5sum format) when the tool closes the pipe.  Any other files that the tool
+    writes next to the pipe (i.e., indexes) are moved next to the output file by
+    close().  If a named pipe can not be made then the tool writes the output file
+    directly and the md5 sum is computed by close().
+    """
+    block_size = 1 << 20
+
+    def __init__(self, output, md5_file):
+        """Set up the pipe and start the copy thread
+
+        output   -- the output file
+        md5_file -- the file for the md5 sum
+        """
+        self.output = output
+        self.md5_file = md5_file
+        self.md5 = hashlib.md5()
+        self.error = None
+        self.thread = None
+        self.opened = th.Event()
+        self.dir = tempfile.mkdtemp(prefix='gemBS_md5_')
+        self.path = os.path.join(self.dir, os.path.basename(output))
+        try:
+            os.mkfifo(self.path)
+        except (OSError, AttributeError) as e:
+            logging.debug("Could not make named pipe {}: {}".format(self.path, e))
+            os.rmdir(self.dir)
+            self.dir = None
+            self.path = output
+            return
+        self.thread = th.Thread(target=self._copy, daemon=True)
+        self.thread.start()
+
+    def _copy(self):
+        try:
+            with open(self.path, 'rb') as fin:
+                self.opened.set()
+                with open(self.output, 'wb') as fout:
+                    while True:
+                        buf = fin.read(self.block_size)
+                        if not buf:
+                            break
+                        self.md5.update(buf)
+                        fout.write(buf)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.opened.set()
+
+    def close(self, ok=True):
+        """Finish the output after the tool has exited (ok is False if the tool failed,
+        in which case the md5 file is not written).  Returns True if the output and
+        md5 file were written successfully"""
+        if self.thread != None:
+            # If the tool never opened the pipe then the copy thread is still waiting
+            # for a writer.  Opening the pipe for reading and writing does not block, so
+            # we hold it open until the thread has opened its end, and then close it
+            # so the thread sees the end of the input
+            if not self.opened.is_set():
+                fd = os.open(self.path, os.O_RDWR)
+                self.opened.wait()
+                os.close(fd)
+            self.thread.join()
+            os.remove(self.path)
+            for f in os.listdir(self.dir):
+                shutil.move(os.path.join(self.dir, f), os.path.join(os.path.dirname(self.output), f))
+            os.rmdir(self.dir)
+        elif ok:
+            try:
+                with open(self.output, 'rb') as f:
+                    for buf in iter(lambda: f.read(self.block_size), b''):
+                        self.md5.update(buf)
+            except OSError as e:
+                self.error = e
+        if self.error != None:
+            logging.error("Error writing {}: {}".format(self.output, self.error))
+            ok = False
+        if ok:
+            with open(self.md5_file, 'w') as f:
+                f.write("{}  {}\n".format(self.md5.hexdigest(), self.output))
+        return ok
+
+def package_resource(path):
+    """
+    Returns the location of a file or directory installed with the gemBS
+    package, or None if it does not exist
+    """
+    f = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    return f if os.path.exists(f) else None
+
+def strtobool(val):
+    """
+    Convert a string representation of truth to True or False
+    """
+    val = val.lower()
+    if val in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    elif val in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError("invalid truth value {}".format(repr(val)))
+
 def uniqueList(seq):
     """
     Remove duplicates entries in a list
@@ -346,16 +460,365 @@ def uniqueList(seq):
     return [ x for x in seq if not (x in seen or seen_add(x))]
 
 
-def try_get_exclusive(c):
-    # Sometimes (in particular with the in memory db) we get exceptions here due to
-    # multiple threads trying to get an exclusive lock at the same time.  If this
-    # happens we just sleep a little and try again
+def begin_immediate(c):
+    # Status updates are made in short BEGIN IMMEDIATE transactions.  With the on disk db
+    # sqlite waits for other writers (up to database.busy_timeout), but the in memory db
+    # uses table locks that are not covered by the busy timeout, so if we get a locking
+    # error here we sleep a little and try again
     while(True):
         try:
-            c.execute("BEGIN EXCLUSIVE")
+            c.execute("BEGIN IMMEDIATE")
             break
         except Exception as e:
             if str(e).startswith('database'):
-                time.sleep(.1)
+                time.sleep(.01)
             else:
                 break
+
+
+def parse_region(region):
+    """Split a contig pool entry into (contig, start, end).  Entries are either
+    contig names or regions of a contig in the form contig:start-end (1 based,
+    inclusive).  For whole contigs start and end are None.
+    """
+    m = re.match(r'(.*):(\d+)-(\d+)$', region)
+    if m:
+        return (m.group(1), int(m.group(2)), int(m.group(3)))
+    return (region, None, None)
+
+def parse_chunk(fname):
+    """Get (chunk, number of chunks) from the name of the BAM file (or pool shards file)
+    for one chunk of a dataset (<dataset>.chunk<k>of<n>.bam), or None if fname is not
+    for a chunk
+    """
+    m = re.search(r'[.]chunk(\d+)of(\d+)[.](bam|shards)$', fname)
+    if m:
+        return (int(m.group(1)), int(m.group(2)))
+    return None
+
+def shard_contig(ctg, size, shard_size):
+    """Split a contig into regions of (at most) shard_size bases.  Returns a list of
+    (pool name, region) pairs, with the pools named contig@1, contig@2, ...
+    """
+    regions = []
+    start = 1
+    ix = 1
+    while start <= size:
+        end = min(start + shard_size - 1, size)
+        # Avoid a very short final shard
+        if size - end < shard_size // 4:
+            end = size
+        regions.append(("{}@{}".format(ctg, ix), "{}:{}-{}".format(ctg, start, end)))
+        start = end + 1
+        ix += 1
+    return regions
+
+def bcf_sort_key(fname):
+    """Sort key for pool BCF files so that the BCFs for shards of a contig
+    (sample_contig@1.bcf, sample_contig@2.bcf ...) are ordered by position"""
+    m = re.match(r'(.*)@(\d+)[.]bcf$', fname)
+    if m:
+        return (m.group(1), int(m.group(2)))
+    return (fname[:-4] if fname.endswith('.bcf') else fname, 0)
+
+def bam_contigs(bam):
+    """Return the list of (contig, length) pairs from the header of a BAM file"""
+    with gzip.open(bam, 'rb') as f:
+        if f.read(4) != b'BAM\1':
+            raise ValueError("File {} is not a BAM file".format(bam))
+        l_text = struct.unpack('<i', f.read(4))[0]
+        f.read(l_text)
+        n_ref = struct.unpack('<i', f.read(4))[0]
+        contigs = []
+        for i in range(n_ref):
+            l_name = struct.unpack('<i', f.read(4))[0]
+            name = f.read(l_name)[:-1].decode()
+            l_ref = struct.unpack('<i', f.read(4))[0]
+            contigs.append((name, l_ref))
+    return contigs
+
+def index_mapped_reads(index):
+    """Return a list with the number of mapped reads for each reference from a
+    BAI or CSI index.  The counts are taken from the pseudo-bin that samtools
+    stores for each reference (the same information shown by samtools idxstats).
+    """
+    if index.endswith('.csi'):
+        with gzip.open(index, 'rb') as f:
+            buf = f.read()
+        if buf[:4] != b'CSI\1':
+            raise ValueError("File {} is not a CSI index".format(index))
+        min_shift, depth, l_aux = struct.unpack_from('<iii', buf, 4)
+        pos = 16 + l_aux
+        pseudo_bin = (((1 << ((depth + 1) * 3)) - 1) // 7) + 1
+        bin_head = 12
+    else:
+        with open(index, 'rb') as f:
+            buf = f.read()
+        if buf[:4] != b'BAI\1':
+            raise ValueError("File {} is not a BAI index".format(index))
+        pos = 4
+        pseudo_bin = 37450
+        bin_head = 4
+    n_ref = struct.unpack_from('<i', buf, pos)[0]
+    pos += 4
+    counts = []
+    for i in range(n_ref):
+        n_bin = struct.unpack_from('<i', buf, pos)[0]
+        pos += 4
+        mapped = 0
+        for j in range(n_bin):
+            bin_no = struct.unpack_from('<I', buf, pos)[0]
+            n_chunk = struct.unpack_from('<i', buf, pos + bin_head)[0]
+            pos += bin_head + 4
+            if bin_no == pseudo_bin and n_chunk == 2:
+                mapped = struct.unpack_from('<Q', buf, pos + 16)[0]
+            pos += n_chunk * 16
+        if bin_head == 4:
+            # BAI linear index
+            n_intv = struct.unpack_from('<i', buf, pos)[0]
+            pos += 4 + n_intv * 8
+        counts.append(mapped)
+    return counts
+
+def bam_mapped_reads(bam):
+    """Return a dict with the number of mapped reads per contig for an indexed BAM
+    file, or None if no BAI or CSI index is found for the file.
+    """
+    base = bam[:-4] if bam.endswith('.bam') else bam
+    for index in (bam + '.csi', base + '.csi', bam + '.bai', base + '.bai'):
+        if os.path.isfile(index):
+            break
+    else:
+        return None
+    contigs = bam_contigs(bam)
+    counts = index_mapped_reads(index)
+    return {ctg[0]: n for ctg, n in zip(contigs, counts)}
+
+def parse_memory(mem):
+    """Convert a memory specification (as used by samtools, i.e. '768M', '4G')
+    to a number of bytes.  Plain numbers are taken as bytes.
+
+    mem -- the memory specification (string or number)
+    """
+    if mem is None or mem == '':
+        return 0
+    if isinstance(mem, (int, float)):
+        return int(mem)
+    mem = str(mem).strip().upper()
+    if mem.endswith('B'):
+        mem = mem[:-1]
+    mult = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}.get(mem[-1:])
+    if mult:
+        return int(float(mem[:-1]) * mult)
+    return int(float(mem))
+
+def node_cores():
+    """Number of cores available to this process"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def node_memory():
+    """Physical memory of the node in bytes (0 if it can not be determined)"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+class ResourceGrant:
+    """Resources handed out by a ResourceScheduler for a single task"""
+    def __init__(self, name, threads, memory):
+        self.name = name
+        self.threads = threads
+        self.memory = memory
+
+class ResourceScheduler:
+    """Admits tasks against a global node budget of cores and memory.
+
+    Each task type is declared once with the number of threads it would like,
+    the minimum number of threads it can usefully run with and its memory
+    requirements (a fixed amount plus an amount per thread).  When a task is
+    started the scheduler blocks until it can be admitted without exceeding
+    the budget, and returns the number of threads the task should use.  If
+    fewer than the requested threads are free the task is started with what is
+    available (but never fewer than min_threads), so that the node is kept
+    saturated without being oversubscribed or running out of memory.
+
+    A task that on its own needs more than the whole budget is admitted (with
+    a warning) only when nothing else is running, so it can not deadlock.
+    """
+    def __init__(self, cores=None, memory=None):
+        """Create a scheduler
+
+        cores  -- number of cores in the budget (default: all cores available to the process)
+        memory -- memory budget as bytes or a string such as '64G' (default: physical memory)
+        """
+        self.cores = int(cores) if cores else node_cores()
+        self.memory = parse_memory(memory) if memory else node_memory()
+        self.free_cores = self.cores
+        self.free_memory = self.memory
+        self.task_types = {}
+        self.cond = th.Condition()
+
+    def declare(self, name, threads=1, min_threads=1, memory=0, thread_memory=0, jobs=None):
+        """Declare the requirements of a task type
+
+        name          -- name of the task type
+        threads       -- requested number of threads.  If None the cores are shared out
+                         equally between jobs parallel tasks
+        min_threads   -- minimum number of threads the task can be started with
+        memory        -- fixed memory requirement of the task
+        thread_memory -- extra memory required per thread
+        jobs          -- expected number of parallel tasks (only used if threads is None)
+        """
+        if threads is None:
+            threads = self.cores // jobs if jobs else 1
+        threads = max(1, min(int(threads), self.cores))
+        min_threads = max(1, min(int(min_threads), threads))
+        self.task_types[name] = (threads, min_threads, parse_memory(memory), parse_memory(thread_memory))
+
+    def acquire(self, name):
+        """Block until a task of the given type can be admitted and return
+        a ResourceGrant giving the threads and memory allocated to it
+        """
+        threads, min_threads, memory, thread_memory = self.task_types[name]
+        with self.cond:
+            while True:
+                nt = min(threads, self.free_cores)
+                if self.memory:
+                    while nt >= min_threads and memory + nt * thread_memory > self.free_memory:
+                        nt -= 1
+                if nt >= min_threads:
+                    break
+                if self.free_cores == self.cores:
+                    # Nothing else running, so waiting will not help
+                    nt = min_threads
+                    logging.warning("Task {} requires more memory than the node budget".format(name))
+                    break
+                self.cond.wait()
+            mem = memory + nt * thread_memory
+            self.free_cores -= nt
+            self.free_memory -= mem
+        return ResourceGrant(name, nt, mem)
+
+    def release(self, grant):
+        """Return the resources of a finished task to the budget"""
+        with self.cond:
+            self.free_cores += grant.threads
+            self.free_memory += grant.memory
+            self.cond.notify_all()
+
+class StatCache:
+    """Answers file existence and mtime queries from a single scan of each directory.
+
+    On network filesystems every stat call is a metadata round trip, so rather than
+    checking each expected output file separately the directories are listed once
+    (several at a time with scan()) and the queries are answered from memory.  The
+    cache is not updated, so it should only be used for a single pass over the files.
+    """
+    def __init__(self, threads=8):
+        """Create an empty cache
+
+        threads -- number of directories scanned in parallel by scan()
+        """
+        self.threads = threads
+        self.dirs = {}
+        self.lock = th.Lock()
+
+    def _scan_dir(self, dname):
+        entries = {}
+        try:
+            with os.scandir(dname) as it:
+                for entry in it:
+                    entries[entry.name] = entry
+        except OSError:
+            pass
+        with self.lock:
+            self.dirs[dname] = entries
+        return entries
+
+    def scan(self, dirs):
+        """Scan the given directories (those not already in the cache) in parallel"""
+        todo = []
+        for dname in dirs:
+            dname = dname if dname else '.'
+            if not dname in self.dirs and not dname in todo:
+                todo.append(dname)
+        if len(todo) > 1 and self.threads > 1:
+            with ThreadPoolExecutor(max_workers = min(self.threads, len(todo))) as ex:
+                list(ex.map(self._scan_dir, todo))
+        else:
+            for dname in todo:
+                self._scan_dir(dname)
+
+    def _entry(self, path):
+        dname, name = os.path.split(path)
+        dname = dname if dname else '.'
+        entries = self.dirs.get(dname)
+        if entries == None:
+            entries = self._scan_dir(dname)
+        return entries.get(name)
+
+    def exists(self, path):
+        """True if path exists"""
+        return self._entry(path) != None
+
+    def isfile(self, path):
+        """True if path is a regular file (or a link to one)"""
+        entry = self._entry(path)
+        try:
+            return entry != None and entry.is_file()
+        except OSError:
+            return False
+
+    def mtime(self, path):
+        """Modification time of path, or None if it does not exist"""
+        entry = self._entry(path)
+        try:
+            return entry.stat().st_mtime if entry != None else None
+        except OSError:
+            return None
+
+class InputFileIndex:
+    """Index of the sequence data files in an input directory by dataset ID.
+
+    The directory is listed once and each file name is parsed once into the name
+    before the extension, the file type and the compression suffix.  The datasets
+    whose IDs occur in the name are found by looking up the substrings of the name
+    with the lengths of the known IDs, so building the index is linear in the number
+    of files rather than requiring a pattern match per file for every dataset.
+    """
+    pattern = re.compile(r"(.*)[.](fastq|fq|fasta|fa|bam|sam)([.][^.]+)?$")
+    compression = (None, '.gz', '.xz', 'bz2', 'z')
+
+    def __init__(self, dname, ids):
+        """Index the files in a directory
+
+        dname -- the input directory
+        ids   -- the dataset IDs (including alternative IDs) that will be looked up
+        """
+        self.dname = dname
+        self.files = {}
+        ids = set(x for x in ids if x)
+        lengths = sorted(set(len(x) for x in ids))
+        for name in os.listdir(dname):
+            m = self.pattern.match(name)
+            if not m or not m.group(3) in self.compression:
+                continue
+            base = m.group(1)
+            # If an ID occurs more than once the last occurrence is used
+            found = {}
+            for l in lengths:
+                for i in range(len(base) - l + 1):
+                    if base[i:i + l] in ids:
+                        found[base[i:i + l]] = i
+            for fli, i in found.items():
+                rest = base[i + len(fli):]
+                end = rest[-1] if rest and rest[-1] in '12' else None
+                self.files.setdefault(fli, []).append((name, base[:i], rest[:-1] if end else rest, end, m.group(2)))
+
+    def get(self, fli):
+        """Files for dataset fli as a list of tuples (file name, text before the ID,
+        text after the ID, read end or None, file type)"""
+        return self.files.get(fli, [])
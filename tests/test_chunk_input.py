@@ -0,0 +1,101 @@
+"""Tests for splitting a dataset into chunks for mapping (gemBS.chunk_input)"""
+import os
+import gzip
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import gemBS
+
+def run_pipeline(cmds):
+    """Run a list of commands as a pipeline and return the output of the last one"""
+    procs = []
+    stdin = None
+    for com in cmds:
+        p = subprocess.Popen(com, stdin = stdin, stdout = subprocess.PIPE)
+        if stdin != None:
+            stdin.close()
+        stdin = p.stdout
+        procs.append(p)
+    out = procs[-1].stdout.read().decode()
+    procs[-1].stdout.close()
+    for p in procs:
+        if p.wait() != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+    return out
+
+@unittest.skipIf(shutil.which('awk') == None, "awk not available")
+class ChunkInputTest(unittest.TestCase):
+    nreads = 11
+    nchunks = 3
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.block_size = gemBS.chunk_block_size
+        gemBS.chunk_block_size = 2
+
+    def tearDown(self):
+        gemBS.chunk_block_size = self.block_size
+        shutil.rmtree(self.dir)
+
+    def write(self, name, records, compress = False):
+        path = os.path.join(self.dir, name)
+        with (gzip.open(path, 'wt') if compress else open(path, 'w')) as f:
+            for r in records:
+                f.write(r)
+        return path
+
+    def fastq(self, end):
+        return ["@read{}/{}\nACGT{}\n+\nIIII{}\n".format(i, end, 'A' * i, 'I' * i) for i in range(self.nreads)]
+
+    def fasta(self, end):
+        # Sequences split over two lines
+        return [">read{}/{}\nACGT\n{}\n".format(i, end, 'C' * (i + 1)) for i in range(self.nreads)]
+
+    def chunks(self, files, paired):
+        return [run_pipeline(gemBS.chunk_input(inputFiles = files, ftype = 'PAIRED' if paired else 'SINGLE', paired = paired,
+                                               chunk = (k, self.nchunks))) for k in range(1, self.nchunks + 1)]
+
+    def check_pairs(self, out, start):
+        # Reads must alternate between the two ends of the same pair
+        names = [l for l in out.split('\n') if l.startswith(start)]
+        self.assertEqual(len(names) % 2, 0)
+        for r1, r2 in zip(names[0::2], names[1::2]):
+            self.assertEqual(r1[:-2] + '/1', r1)
+            self.assertEqual(r1[:-2] + '/2', r2)
+        return [x[1:-2] for x in names[0::2]]
+
+    def check_chunks(self, outs, start):
+        pairs = [self.check_pairs(out, start) for out in outs]
+        # Every pair is in exactly one chunk, in blocks of chunk_block_size
+        self.assertEqual(sorted(sum(pairs, []), key = lambda x: int(x[4:])), ["read{}".format(i) for i in range(self.nreads)])
+        self.assertEqual(pairs[0][:2], ['read0', 'read1'])
+        self.assertEqual(pairs[1][:2], ['read2', 'read3'])
+
+    def test_paired_fastq(self):
+        files = [self.write('r1.fq', self.fastq(1)), self.write('r2.fq.gz', self.fastq(2), True)]
+        outs = self.chunks(files, True)
+        self.check_chunks(outs, '@')
+        self.assertEqual(sum(len(out.split('\n')) - 1 for out in outs), self.nreads * 8)
+
+    def test_paired_fasta(self):
+        files = [self.write('r1.fa', self.fasta(1)), self.write('r2.fa', self.fasta(2))]
+        outs = self.chunks(files, True)
+        self.check_chunks(outs, '>')
+        self.assertEqual(''.join(outs).count('ACGT\nC'), self.nreads * 2)
+
+    def test_interleaved_fasta(self):
+        records = []
+        for r1, r2 in zip(self.fasta(1), self.fasta(2)):
+            records.extend([r1, r2])
+        outs = self.chunks([self.write('r.fa', records)], True)
+        self.check_chunks(outs, '>')
+
+    def test_uneven_pairs(self):
+        files = [self.write('r1.fa', self.fasta(1)), self.write('r2.fa', self.fasta(2)[:-1])]
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.chunks(files, True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Start-up time regression check for the gemBS command line.
+
+Times 'python -c "import gemBS.commands"' over a number of runs and fails if
+the median time is above the threshold, or if the import pulls in any of the
+report modules (which must only be loaded by the report commands).
+
+    python tools/bench_startup.py [-n RUNS] [-t SECONDS]
+"""
+import os
+import sys
+import argparse
+import subprocess
+import time
+
+# Modules that must not be loaded just to start the command line
+heavy_modules = ['matplotlib', 'mpl_toolkits', 'numpy', 'multiprocess', 'pkg_resources',
+                 'gemBS.report', 'gemBS.reportStats', 'gemBS.sphinx', 'gemBS.bsCallReports',
+                 'gemBS.bsCallSphinxReports', 'gemBS.bsCallStats']
+
+check_code = """
+import sys
+import gemBS.commands
+heavy = {}
+print(' '.join(m for m in sys.modules if m in heavy or m.split('.')[0] in heavy))
+""".format(heavy_modules)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Time the start-up of the gemBS command line")
+    parser.add_argument('-n', '--runs', type = int, default = 10, help = 'Number of runs (default 10)')
+    parser.add_argument('-t', '--threshold', type = float, default = 0.5, help = 'Maximum median start-up time in seconds (default 0.5)')
+    parser.add_argument('--python', default = sys.executable, help = 'Python interpreter to use')
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    pwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = pwd + os.pathsep + env['PYTHONPATH'] if env.get('PYTHONPATH') else pwd
+
+    ok = True
+    ret = subprocess.run([args.python, '-c', check_code], env = env, stdout = subprocess.PIPE, universal_newlines = True)
+    if ret.returncode != 0:
+        print("import gemBS.commands failed", file = sys.stderr)
+        sys.exit(1)
+    loaded = ret.stdout.split()
+    if loaded:
+        print("Modules loaded at start-up: {}".format(', '.join(loaded)))
+        ok = False
+
+    times = []
+    for i in range(max(1, args.runs)):
+        start = time.perf_counter()
+        subprocess.run([args.python, '-c', 'import gemBS.commands'], env = env, check = True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    median = times[len(times) // 2]
+    print("Start-up time over {} runs: min {:.3f}s, median {:.3f}s, max {:.3f}s (threshold {:.3f}s)".format(
+        len(times), times[0], median, times[-1], args.threshold))
+    if median > args.threshold:
+        print("Median start-up time is above the threshold")
+        ok = False
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()